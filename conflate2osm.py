@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# conflate2osm
+# Compares OSM files produced by post2osm.py with existing post offices, parcel lockers and post boxes in OSM
+# Usage: python conflate2osm.py <extract> [input files]
+# The extract is a local OSM file (.osm, .osm.gz or .osm.pbf), for example Norway from Geofabrik.
+# Default input files are 'postkontor.osm' and 'postkasser.osm'.
+# Creates output files with "_conflate" added to the input file names, e.g. 'postkontor_conflate.osm'.
+# Each unit is tagged CONFLATE=match/move/new, and OSM features not matched by any unit are added with CONFLATE=orphan.
+
+
+import sys
+import os
+import math
+
+import osmfile
+
+
+version = "1.0.0"
+
+match_radius = 50  # Meters (units without ref match are matched to closest OSM feature within x meters)
+
+move_distance = 20  # Meters (units matched by ref are reported as moved if more than x meters from OSM feature)
+
+ref_keys = {
+	'post_office':		'ref:posten',
+	'parcel_locker':	'ref:posten',
+	'post_box':			'ref:posten_box'
+}
+
+
+
+def message (output_text):
+	'''
+	Output message to console.
+	'''
+
+	sys.stdout.write (output_text)
+	sys.stdout.flush()
+
+
+
+def project(latitude, longitude):
+	'''
+	Simplified projection to meters, good enough for short distances.
+	'''
+
+	y = math.radians(latitude)
+	x = math.radians(longitude) * math.cos(y)
+	return (6371000 * x, 6371000 * y)
+
+
+
+def build_kdtree(features, depth=0):
+	'''
+	Build 2-d tree from list of features with projected 'xy' point.
+	Each tree node is a tuple (feature, axis, left subtree, right subtree).
+	'''
+
+	if not features:
+		return None
+
+	axis = depth % 2
+	features = sorted(features, key=lambda feature: feature['xy'][axis])
+	median = len(features) // 2
+
+	return (features[median], axis,
+			build_kdtree(features[:median], depth + 1),
+			build_kdtree(features[median + 1:], depth + 1))
+
+
+
+def nearest(tree, point, radius, accept):
+	'''
+	Find closest feature in tree within radius meters of projected point, among features accepted by the given function.
+	Returns (feature, distance), or (None, radius) if none found.
+	'''
+
+	best = [None, radius]
+
+	def search(node):
+		if node is None:
+			return
+
+		feature, axis, left, right = node
+		dx = feature['xy'][0] - point[0]
+		dy = feature['xy'][1] - point[1]
+		distance = math.sqrt(dx*dx + dy*dy)
+		if distance <= best[1] and accept(feature):
+			best[0] = feature
+			best[1] = distance
+
+		diff = point[axis] - feature['xy'][axis]
+		if diff < 0:
+			near, far = left, right
+		else:
+			near, far = right, left
+
+		search(near)
+		if abs(diff) <= best[1]:
+			search(far)
+
+	search(tree)
+	return (best[0], best[1])
+
+
+
+def is_posten_feature(tags):
+	'''
+	Check if OSM feature should be considered for conflation.
+	Parcel lockers are only included if they belong to Posten, since there are other operators.
+	'''
+
+	amenity = tags.get('amenity', None)
+
+	if amenity in ['post_office', 'post_box']:
+		return True
+
+	if amenity == "parcel_locker":
+		return "ref:posten" in tags or \
+				any("posten" in tags.get(key, "").lower() for key in ['brand', 'operator', 'name'])
+
+	return False
+
+
+
+def load_extract(filename):
+	'''
+	Load post offices, parcel lockers and post boxes from OSM extract in one streaming pass.
+	Only matching nodes are kept in memory. Features mapped as ways or relations are not included.
+	'''
+
+	message ("Load post features from '%s' ...\n" % filename)
+
+	features = []
+	count = 0
+
+	for node_id, latitude, longitude, tags in osmfile.read_nodes(filename):
+		count += 1
+		if tags and is_posten_feature(tags):
+			feature = {
+				'id':		node_id,
+				'point':	(latitude, longitude),
+				'xy':		project(latitude, longitude),
+				'tags':		tags,
+				'matched':	False
+			}
+			features.append(feature)
+
+	message ("\t%i of %i nodes loaded\n" % (len(features), count))
+
+	return features
+
+
+
+def conflate(filename, features):
+	'''
+	Match units in OSM file from post2osm.py with features from OSM extract and save result to file.
+	Units are first matched by ref:posten/ref:posten_box, then by closest feature of same amenity within radius without any ref.
+	'''
+
+	message ("Conflate '%s' ...\n" % filename)
+
+	units = []
+	for node_id, latitude, longitude, tags in osmfile.read_nodes(filename):
+		units.append({
+			'id':		node_id,
+			'point':	(latitude, longitude),
+			'xy':		project(latitude, longitude),
+			'tags':		tags
+		})
+
+	amenities = set(unit['tags'].get('amenity', None) for unit in units)
+	candidates = [ feature for feature in features if feature['tags']['amenity'] in amenities ]
+
+	for feature in candidates:
+		feature['matched'] = False
+
+	# Index features by ref (one feature may have several refs separated by ";")
+
+	refs = {}
+	for feature in candidates:
+		ref_key = ref_keys[ feature['tags']['amenity'] ]
+		if ref_key in feature['tags']:
+			for ref in feature['tags'][ref_key].split(";"):
+				refs[ (ref_key, ref.strip()) ] = feature
+
+	tree = build_kdtree(candidates)
+
+	count = {'match': 0, 'move': 0, 'new': 0, 'orphan': 0}
+
+	# Pass 1: Match by ref
+
+	for unit in units:
+		ref_key = ref_keys.get(unit['tags'].get('amenity', None), None)
+		feature = refs.get((ref_key, unit['tags'].get(ref_key, None)), None)
+
+		if feature is not None and not feature['matched']:
+			feature['matched'] = True
+			unit['feature'] = feature
+			unit['distance'] = math.sqrt((feature['xy'][0] - unit['xy'][0])**2 + (feature['xy'][1] - unit['xy'][1])**2)
+			unit['match'] = "ref"
+
+	# Pass 2: Match by closest feature of same amenity (not for units without coordinates).
+	# Features with a ref are not included, since their ref did not match any unit (they are reported as orphans).
+
+	for unit in units:
+		if "feature" not in unit and "GEOCODE" not in unit['tags']:
+			amenity = unit['tags'].get('amenity', None)
+			feature, distance = nearest(tree, unit['xy'], match_radius,
+								lambda feature: not feature['matched'] and feature['tags']['amenity'] == amenity
+												and ref_keys[amenity] not in feature['tags'])
+
+			if feature is not None:
+				feature['matched'] = True
+				unit['feature'] = feature
+				unit['distance'] = distance
+				unit['match'] = "nearest"
+
+	# Save result
+
+	basename = filename
+	for extension in osmfile.file_formats.values():
+		if filename.endswith(extension):
+			basename = filename[ : -len(extension) ]
+			break
+
+	output_name = basename + "_conflate.osm"
+	output = osmfile.open_writer(output_name, "conflate2osm v%s" % version)
+
+	node_id = -1000
+
+	for unit in units:
+		node_id -= 1
+		tags = list(unit['tags'].items())
+
+		if "feature" in unit:
+			if unit['match'] == "ref" and unit['distance'] > move_distance:
+				result = "move"
+			else:
+				result = "match"
+			tags += [ ("CONFLATE", result), ("MATCH", unit['match']), ("OSM_ID", str(unit['feature']['id'])),
+						("DISTANCE", "%.1f" % unit['distance']) ]
+		else:
+			result = "new"
+			tags.append(("CONFLATE", result))
+
+		count[ result ] += 1
+		output.node(node_id, "%.7f" % unit['point'][0], "%.7f" % unit['point'][1], tags)
+
+	for feature in candidates:
+		if not feature['matched']:
+			node_id -= 1
+			tags = list(feature['tags'].items()) + [ ("CONFLATE", "orphan"), ("OSM_ID", str(feature['id'])) ]
+			output.node(node_id, "%.7f" % feature['point'][0], "%.7f" % feature['point'][1], tags)
+			count['orphan'] += 1
+
+	output.close()
+
+	message ("\t%i matched, %i moved, %i new, %i orphans saved to '%s'\n" % (count['match'], count['move'], count['new'], count['orphan'], output_name))
+
+
+
+# Main program
+
+if __name__ == '__main__':
+
+	if len(sys.argv) < 2:
+		sys.exit("Usage: python conflate2osm.py <extract> [input files]")
+
+	features = load_extract(sys.argv[1])
+
+	if len(sys.argv) > 2:
+		filenames = sys.argv[2:]
+	else:
+		filenames = ["postkontor.osm", "postkasser.osm"]
+
+	for filename in filenames:
+		if os.path.isfile(filename):
+			conflate(filename, features)
+		else:
+			message ("File '%s' not found\n" % filename)
+
+	message ("\n")
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# download
+# Streaming download of Posten and Geonorge api responses, used by post2osm.py and postbox2osm.py
+# Connect and read timeouts, retries with exponential backoff and resume with Range requests where supported.
+# Resume is only done if the server confirms that the document is unchanged (same ETag/Last-Modified and size).
+# Otherwise the download is restarted from the beginning when reading all data at once.
+# The raw response may be saved to a file while it is being parsed, so that it can be replayed without a new download.
+
+
+import sys
+import os
+import time
+import http.client
+import urllib.parse
+
+
+connect_timeout = 30  # Seconds to wait for connection to server
+
+read_timeout = 120  # Seconds to wait for more data from server
+
+max_retries = 5  # Number of retries after errors before giving up (counted since last successful read)
+
+retry_delay = 2  # Seconds before first retry, doubled for each retry
+
+max_retry_delay = 60  # Max seconds between retries
+
+max_redirects = 5
+
+chunk_size = 65536  # Bytes per read when draining or skipping data
+
+
+
+class DownloadError(Exception):
+	'''
+	Download failed after retries, or server returned error status.
+	'''
+	pass
+
+
+
+class DocumentChanged(DownloadError):
+	'''
+	Document on server changed during download, so the download cannot be resumed.
+	'''
+	pass
+
+
+
+def message (output_text):
+	'''
+	Output message to console.
+	'''
+
+	sys.stdout.write (output_text)
+	sys.stdout.flush()
+
+
+
+class DownloadStream:
+	'''
+	File-like object for reading a url, with reconnect and resume after errors.
+	Raw data is copied to tee_filename if given. The file is saved under its final name when the download is complete.
+	'''
+
+	def __init__(self, url, tee_filename=None):
+
+		self.url = url
+		self.offset = 0  # Number of bytes delivered so far
+		self.total = None  # Total size from Content-Length, if given by server
+		self.validators = None  # (ETag, Last-Modified) of first response, used to check that resumed document is unchanged
+		self.restarts = 0
+		self.connection = None
+		self.response = None
+		self.complete = False
+		self.tee_filename = tee_filename
+		self.tee = None
+
+		if tee_filename:
+			self.tee = open(tee_filename + ".part", "wb")
+
+		try:
+			self.retry(self.connect)
+		except DownloadError:
+			self.abort()
+			raise
+
+
+	def connect(self):
+		'''
+		Connect to server and request data from current offset, following redirects.
+		'''
+
+		self.disconnect()
+		url = self.url
+
+		for redirect in range(max_redirects + 1):
+
+			parts = urllib.parse.urlsplit(url)
+			if parts.scheme == "https":
+				connection = http.client.HTTPSConnection(parts.netloc, timeout=connect_timeout)
+			else:
+				connection = http.client.HTTPConnection(parts.netloc, timeout=connect_timeout)
+
+			connection.connect()
+			connection.sock.settimeout(read_timeout)
+
+			headers = { 'User-Agent': "post2osm" }
+			if self.offset > 0 and any(self.validators):
+				etag, last_modified = self.validators
+				headers['Range'] = "bytes=%i-" % self.offset
+				if etag and not etag.startswith("W/"):
+					headers['If-Range'] = etag  # Server sends whole document if changed
+				elif last_modified:
+					headers['If-Range'] = last_modified
+
+			path = parts.path or "/"
+			if parts.query:
+				path += "?" + parts.query
+
+			connection.request("GET", path, headers=headers)
+			response = connection.getresponse()
+
+			if response.status in [301, 302, 303, 307, 308] and response.getheader("Location"):
+				url = urllib.parse.urljoin(url, response.getheader("Location"))
+				connection.close()
+				continue
+
+			break
+
+		else:
+			connection.close()
+			raise DownloadError("Too many redirects: %s" % self.url)
+
+		self.connection = connection
+		self.response = response
+
+		if response.status == 416 and self.total is not None and self.offset >= self.total:  # Nothing left to resume
+			self.complete = True
+			return
+
+		if response.status >= 500:
+			raise http.client.HTTPException("HTTP status %i" % response.status)
+
+		if response.status not in [200, 206]:
+			self.disconnect()
+			raise DownloadError("HTTP status %i: %s" % (response.status, self.url))
+
+		# Find start and total size of data from server
+
+		start = 0
+		total = None
+		if response.status == 206:
+			content_range = response.getheader("Content-Range", "")
+			if content_range.startswith("bytes ") and "-" in content_range:
+				start = int(content_range[6:].split("-")[0])
+				if "/" in content_range and content_range.split("/")[1].strip().isdigit():
+					total = int(content_range.split("/")[1])
+		elif response.getheader("Content-Length", "").isdigit():
+			total = int(response.getheader("Content-Length"))
+
+		validators = (response.getheader("ETag"), response.getheader("Last-Modified"))
+
+		# Check that document is unchanged before resuming, since data from two documents must not be joined
+
+		if self.offset > 0:
+			if self.validators is None or not any(self.validators) or validators != self.validators or total != self.total:
+				self.disconnect()
+				raise DocumentChanged("Document changed on server during download, cannot resume: %s" % self.url)
+		else:
+			self.validators = validators
+
+		self.total = total
+
+		if start > self.offset:
+			raise DownloadError("Server resumed at wrong position: %s" % self.url)
+
+		# Skip data already delivered
+
+		skip = self.offset - start
+		while skip > 0:
+			data = response.read(min(skip, chunk_size))
+			if not data:
+				raise http.client.IncompleteRead(b"", skip)
+			skip -= len(data)
+
+
+	def disconnect(self):
+
+		if self.connection is not None:
+			self.connection.close()
+		self.connection = None
+		self.response = None
+
+
+	def retry(self, function, *args):
+		'''
+		Call function, reconnecting and retrying with exponential backoff after network errors.
+		'''
+
+		attempt = 0
+
+		while True:
+			try:
+				if self.response is None and function != self.connect:
+					self.connect()
+				return function(*args)
+
+			except (OSError, http.client.HTTPException) as error:
+				self.disconnect()
+				if attempt >= max_retries:
+					raise DownloadError("Download failed after %i retries: %s (%s)" % (max_retries, self.url, error))
+
+				delay = min(retry_delay * 2 ** attempt, max_retry_delay)
+				attempt += 1
+				message ("\tDownload error at byte %i (%s), retry %i of %i in %i seconds\n" % (self.offset, error, attempt, max_retries, delay))
+				time.sleep(delay)
+
+
+	def read_response(self, size):
+
+		if self.complete:
+			return b""
+
+		data = self.response.read(size)
+
+		if not data and self.total is not None and self.offset < self.total:
+			raise http.client.IncompleteRead(b"", self.total - self.offset)
+
+		return data
+
+
+	def read(self, size=-1):
+		'''
+		Read up to size bytes, or all remaining data if size is negative.
+		'''
+
+		if self.complete:
+			return b""
+
+		if size is None or size < 0:
+			chunks = []
+			while True:
+				try:
+					data = self.read(chunk_size)
+				except DocumentChanged:
+					if self.restarts >= max_retries:
+						raise
+					self.restart()
+					chunks = []
+					continue
+				if not data:
+					return b"".join(chunks)
+				chunks.append(data)
+
+		data = self.retry(self.read_response, size)
+
+		if data:
+			self.offset += len(data)
+			if self.tee:
+				self.tee.write(data)
+		elif size > 0:
+			self.finish()
+
+		return data
+
+
+	def restart(self):
+		'''
+		Discard data delivered so far and start download again from the beginning.
+		Only possible when the caller reads all data at once, since delivered data cannot be taken back otherwise.
+		'''
+
+		self.restarts += 1
+		message ("\tDocument changed on server at byte %i, restart download (%i of %i)\n" % (self.offset, self.restarts, max_retries))
+
+		self.disconnect()
+		self.offset = 0
+		self.total = None
+		self.validators = None
+
+		if self.tee:
+			self.tee.seek(0)
+			self.tee.truncate()
+
+
+	def finish(self):
+		'''
+		Mark download as complete and save tee file under its final name.
+		'''
+
+		self.complete = True
+		self.disconnect()
+
+		if self.tee:
+			self.tee.close()
+			self.tee = None
+			os.replace(self.tee_filename + ".part", self.tee_filename)
+
+
+	def close(self):
+		'''
+		Close stream. If a tee file is being written, the rest of the data is read first so that the file is complete.
+		'''
+
+		if self.tee:
+			try:
+				while self.read(chunk_size):
+					pass
+			except DownloadError:
+				self.abort()
+				raise
+
+		self.disconnect()
+
+
+	def abort(self):
+		'''
+		Close stream after failed download and remove incomplete tee file.
+		'''
+
+		self.disconnect()
+
+		if self.tee:
+			self.tee.close()
+			self.tee = None
+			os.remove(self.tee_filename + ".part")
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, traceback):
+
+		if exc_value is None or (isinstance(exc_value, Exception) and not isinstance(exc_value, DownloadError)):
+			self.close()  # Complete tee file, e.g. after parse error
+		else:
+			self.abort()  # Download failed, or interrupted by KeyboardInterrupt/SystemExit
+
+
+
+def open_url(url, tee_filename=None, replay=False):
+	'''
+	Open url for streaming read, optionally copying raw data to tee_filename.
+	If replay is True, the data is read from tee_filename from an earlier download instead.
+	Use read() without size to get the whole document, so that the download can be restarted if the document changes.
+	'''
+
+	if replay:
+		if not os.path.isfile(tee_filename):
+			raise DownloadError("No saved download to replay: '%s'" % tee_filename)
+		return open(tee_filename, "rb")
+
+	return DownloadStream(url, tee_filename)
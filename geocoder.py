@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# geocoder
+# Offline geocoding of addresses from a local copy of Kartverket's address register (CSV file from Geonorge)
+# Used by post2osm.py and postbox2osm.py for units without coordinates from the Posten api.
+# A persistent index (sqlite3 table with primary key) of normalised street, house number and postcode is built next to
+# the CSV file the first time it is used, and rebuilt whenever the CSV file is newer than the index.
+
+
+import sys
+import os
+import csv
+import sqlite3
+import math
+import re
+
+
+index_version = "2"  # Increase to force rebuild of existing indexes
+
+
+
+def message (output_text):
+	'''
+	Output message to console.
+	'''
+
+	sys.stdout.write (output_text)
+	sys.stdout.flush()
+
+
+
+def normalise(text):
+	'''
+	Normalise street name or house number for matching: lower case, no punctuation, single spaces.
+	'''
+
+	text = text.lower().replace(".", " ").replace(",", " ").replace("-", " ")
+	return " ".join(text.split())
+
+
+
+def make_key(street, number, postcode):
+	'''
+	Produce index key from address parts, e.g. ("Storgata", "5B", "0150") -> "storgata|5b|0150".
+	'''
+
+	return "%s|%s|%s" % (normalise(street), normalise(number).replace(" ", ""), postcode.strip())
+
+
+
+def parse_address(address_line):
+	'''
+	Split address from Posten ("Storgata 5B, 0150 OSLO") into street, house number and postcode.
+	Returns None if the address has no house number.
+	'''
+
+	if ", " not in address_line:
+		return None
+
+	street, postal = address_line.rsplit(", ", 1)
+	postcode = postal.split()[0] if postal.split() else ""
+
+	match = re.match(r"^(.+?)\s+(\d+)\s*([A-Za-z]?)$", street.strip())
+	if match is None or not postcode:
+		return None
+
+	return (match.group(1), match.group(2), match.group(3), postcode)
+
+
+
+def utm_to_latlon(easting, northing, zone):
+	'''
+	Convert UTM coordinates (ETRS89/GRS80, northern hemisphere) to latitude and longitude.
+	'''
+
+	a = 6378137.0
+	f = 1 / 298.257222101
+	k0 = 0.9996
+
+	e2 = f * (2 - f)
+	e_prime2 = e2 / (1 - e2)
+	e1 = (1 - math.sqrt(1 - e2)) / (1 + math.sqrt(1 - e2))
+
+	x = easting - 500000.0
+	m = northing / k0
+	mu = m / (a * (1 - e2 / 4 - 3 * e2**2 / 64 - 5 * e2**3 / 256))
+
+	phi1 = mu + (3 * e1 / 2 - 27 * e1**3 / 32) * math.sin(2 * mu) \
+			+ (21 * e1**2 / 16 - 55 * e1**4 / 32) * math.sin(4 * mu) \
+			+ (151 * e1**3 / 96) * math.sin(6 * mu) \
+			+ (1097 * e1**4 / 512) * math.sin(8 * mu)
+
+	n1 = a / math.sqrt(1 - e2 * math.sin(phi1)**2)
+	t1 = math.tan(phi1)**2
+	c1 = e_prime2 * math.cos(phi1)**2
+	r1 = a * (1 - e2) / (1 - e2 * math.sin(phi1)**2)**1.5
+	d = x / (n1 * k0)
+
+	lat = phi1 - (n1 * math.tan(phi1) / r1) * (d**2 / 2 \
+			- (5 + 3 * t1 + 10 * c1 - 4 * c1**2 - 9 * e_prime2) * d**4 / 24 \
+			+ (61 + 90 * t1 + 298 * c1 + 45 * t1**2 - 252 * e_prime2 - 3 * c1**2) * d**6 / 720)
+
+	lon = (d - (1 + 2 * t1 + c1) * d**3 / 6 \
+			+ (5 - 2 * c1 + 28 * t1 - 3 * c1**2 + 8 * e_prime2 + 24 * t1**2) * d**5 / 120) / math.cos(phi1)
+
+	return (math.degrees(lat), (zone - 1) * 6 - 180 + 3 + math.degrees(lon))
+
+
+
+def build_index(csv_filename, index_filename):
+	'''
+	Build sqlite3 index from Kartverket address CSV file (semicolon separated, as downloaded from Geonorge).
+	Uses columns adressenavn, nummer, bokstav, postnummer, Nord, Øst and EPSG-kode.
+	Coordinates may be geographic (EPSG:4258/4326) or UTM (EPSG:25832-25835).
+	The index is built in a temporary file, which replaces any old index when complete.
+	'''
+
+	message ("Build address index from '%s' ...\n" % csv_filename)
+
+	count = 0
+	temp_filename = index_filename + ".tmp"
+	if os.path.isfile(temp_filename):
+		os.remove(temp_filename)
+
+	with open(csv_filename, newline="", encoding="utf-8-sig") as file:
+
+		reader = csv.reader(file, delimiter=";")
+		header = [ column.strip().lower() for column in next(reader) ]
+		column = { name: header.index(name) for name in ['adressenavn', 'nummer', 'bokstav', 'postnummer', 'nord', 'øst', 'epsg-kode'] }
+
+		index = sqlite3.connect(temp_filename)
+		index.execute("CREATE TABLE address (key TEXT PRIMARY KEY, latitude REAL, longitude REAL) WITHOUT ROWID")
+		index.execute("CREATE TABLE source (value TEXT)")
+
+		for row in reader:
+			if not row[ column['nummer'] ] or not row[ column['nord'] ]:
+				continue
+
+			north = float(row[ column['nord'] ].replace(",", "."))
+			east = float(row[ column['øst'] ].replace(",", "."))
+			epsg = int(row[ column['epsg-kode'] ])
+
+			if 25800 < epsg < 25860:
+				latitude, longitude = utm_to_latlon(east, north, epsg - 25800)
+			else:
+				latitude, longitude = north, east
+
+			key = make_key(row[ column['adressenavn'] ], row[ column['nummer'] ] + row[ column['bokstav'] ], row[ column['postnummer'] ])
+			index.execute("INSERT OR REPLACE INTO address VALUES (?, ?, ?)", (key, round(latitude, 7), round(longitude, 7)))
+			count += 1
+
+		index.execute("INSERT INTO source VALUES (?)", ("%s,%i" % (index_version, os.path.getmtime(csv_filename)),))
+		index.commit()
+		index.close()
+
+	os.replace(temp_filename, index_filename)
+
+	message ("\t%i addresses indexed\n" % count)
+
+
+
+def open_index(csv_filename):
+	'''
+	Open address index for CSV file, building it first if missing or older than the CSV file.
+	Returns sqlite3 connection for lookup().
+	'''
+
+	csv_filename = os.path.expanduser(csv_filename)
+	index_filename = csv_filename + ".sqlite"
+
+	source = "%s,%i" % (index_version, os.path.getmtime(csv_filename))
+
+	up_to_date = False
+	if os.path.isfile(index_filename):
+		try:
+			index = sqlite3.connect(index_filename)
+			up_to_date = (index.execute("SELECT value FROM source").fetchone() == (source,))
+			index.close()
+		except sqlite3.Error:
+			pass
+
+	if not up_to_date:
+		build_index(csv_filename, index_filename)
+
+	return sqlite3.connect(index_filename)
+
+
+
+def lookup(index, address_line):
+	'''
+	Look up coordinates for address from Posten, e.g. "Storgata 5B, 0150 OSLO".
+	Tries house number with letter first, then without letter.
+	Returns (latitude, longitude) or None if not found.
+	'''
+
+	address = parse_address(address_line)
+	if address is None:
+		return None
+
+	street, number, letter, postcode = address
+
+	for house_number in [number + letter, number]:
+		coordinates = index.execute("SELECT latitude, longitude FROM address WHERE key = ?", (make_key(street, house_number, postcode),)).fetchone()
+		if coordinates is not None:
+			return coordinates
+
+	return None
@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# osmfile
+# Writers and readers for OSM files used by post2osm.py and postbox2osm.py
+# Supported formats: XML (.osm), gzip compressed XML (.osm.gz), PBF with dense nodes (.osm.pbf),
+# GeoJSON with point features (.geojson) and CSV with one column per tag (.csv)
+
+
+import html
+import gzip
+import struct
+import zlib
+import json
+import csv
+from xml.etree import ElementTree
+
+
+file_formats = {
+	'osm': '.osm',
+	'gz': '.osm.gz',
+	'pbf': '.osm.pbf',
+	'geojson': '.geojson',
+	'csv': '.csv'
+}
+
+pbf_block_size = 8000  # Max number of nodes per PBF block (8000 is the recommended maximum)
+
+
+
+def get_format(filename):
+	'''
+	Get file format from file extension.
+	'''
+
+	for file_format, extension in sorted(file_formats.items(), key=lambda item: -len(item[1])):
+		if filename.endswith(extension):
+			return file_format
+
+	raise ValueError("Unknown file format: '%s'" % filename)
+
+
+
+def output_filename(basename, file_format):
+	'''
+	Get filename for given file format, e.g. "postkasser" + "gz" -> "postkasser.osm.gz".
+	'''
+
+	if file_format not in file_formats:
+		raise ValueError("Unknown file format: '%s'" % file_format)
+
+	return basename + file_formats[file_format]
+
+
+
+# Protobuf encoding for PBF files
+
+def encode_varint(value):
+	'''
+	Encode unsigned integer as protobuf varint.
+	'''
+
+	result = bytearray()
+	while value > 0x7f:
+		result.append((value & 0x7f) | 0x80)
+		value >>= 7
+	result.append(value)
+	return bytes(result)
+
+
+
+def encode_field(field, data):
+	'''
+	Encode length delimited protobuf field (bytes, strings and sub messages).
+	'''
+
+	return encode_varint(field << 3 | 2) + encode_varint(len(data)) + data
+
+
+
+def encode_int_field(field, value):
+	'''
+	Encode varint protobuf field.
+	'''
+
+	return encode_varint(field << 3) + encode_varint(value)
+
+
+
+def encode_packed(field, values):
+	'''
+	Encode packed repeated varint protobuf field.
+	'''
+
+	return encode_field(field, b"".join(encode_varint(value) for value in values))
+
+
+
+def zigzag(value):
+	'''
+	Zigzag encoding of signed integer (sint64).
+	'''
+
+	return (value << 1) ^ (value >> 63)
+
+
+
+def delta(values):
+	'''
+	Delta coding of list of integers, zigzag encoded.
+	'''
+
+	result = []
+	last = 0
+	for value in values:
+		result.append(zigzag(value - last))
+		last = value
+	return result
+
+
+
+# Protobuf decoding for PBF files
+
+def decode_varint(data, position):
+	'''
+	Decode protobuf varint starting at position.
+	Returns value and new position.
+	'''
+
+	value = 0
+	shift = 0
+	while True:
+		byte = data[position]
+		position += 1
+		value |= (byte & 0x7f) << shift
+		if byte < 0x80:
+			return (value, position)
+		shift += 7
+
+
+
+def decode_fields(data):
+	'''
+	Iterate fields of protobuf message.
+	Generates (field, value), where value is integer for varints and bytes for length delimited fields.
+	'''
+
+	position = 0
+	end = len(data)
+
+	while position < end:
+		key, position = decode_varint(data, position)
+		field = key >> 3
+		wire_type = key & 7
+
+		if wire_type == 0:  # Varint
+			value, position = decode_varint(data, position)
+		elif wire_type == 2:  # Length delimited
+			length, position = decode_varint(data, position)
+			value = data[position : position + length]
+			position += length
+		elif wire_type == 1:  # 64 bit
+			value = data[position : position + 8]
+			position += 8
+		elif wire_type == 5:  # 32 bit
+			value = data[position : position + 4]
+			position += 4
+		else:
+			raise ValueError("Unsupported protobuf wire type %i" % wire_type)
+
+		yield (field, value)
+
+
+
+def decode_packed(data):
+	'''
+	Decode packed repeated varints.
+	'''
+
+	values = []
+	position = 0
+	end = len(data)
+	while position < end:
+		value, position = decode_varint(data, position)
+		values.append(value)
+	return values
+
+
+
+def unzigzag(value):
+	'''
+	Decode zigzag encoded signed integer (sint64).
+	'''
+
+	return (value >> 1) ^ -(value & 1)
+
+
+
+def signed(value):
+	'''
+	Decode two's complement varint (int64).
+	'''
+
+	if value >= 1 << 63:
+		value -= 1 << 64
+	return value
+
+
+
+def undelta(values):
+	'''
+	Decode delta coded list of zigzag encoded integers.
+	'''
+
+	result = []
+	last = 0
+	for value in values:
+		last += unzigzag(value)
+		result.append(last)
+	return result
+
+
+
+class XmlWriter:
+	'''
+	Write nodes to OSM XML file, optionally gzip compressed.
+	'''
+
+	def __init__(self, filename, generator, compress=False):
+
+		if compress:
+			self.file = gzip.open(filename, "wt", encoding="utf-8")
+		else:
+			self.file = open(filename, "w", encoding="utf-8")
+
+		self.file.write ('<?xml version="1.0" encoding="UTF-8"?>\n')
+		self.file.write ('<osm version="0.6" generator="%s" upload="false">\n' % generator)
+
+
+	def node(self, node_id, latitude, longitude, tags):
+		'''
+		Write node with list of (key, value) tags. Latitude and longitude are strings.
+		'''
+
+		self.file.write ('  <node id="%i" lat="%s" lon="%s">\n' % (node_id, latitude, longitude))
+		for key, value in tags:
+			self.file.write ('    <tag k="%s" v="%s" />\n' % (key, html.escape(value)))
+		self.file.write ('  </node>\n')
+
+
+	def close(self):
+
+		self.file.write ('</osm>\n')
+		self.file.close()
+
+
+
+class PbfWriter:
+	'''
+	Write nodes to OSM PBF file, using dense nodes and one string table per block.
+	'''
+
+	def __init__(self, filename, generator):
+
+		self.file = open(filename, "wb")
+		self.nodes = []
+
+		header = encode_field(4, b"OsmSchema-V0.6") + encode_field(4, b"DenseNodes") + \
+					encode_field(16, generator.encode("utf-8"))
+		self.write_blob("OSMHeader", header)
+
+
+	def write_blob(self, blob_type, data):
+		'''
+		Write zlib compressed blob with blob header.
+		'''
+
+		blob = encode_int_field(2, len(data)) + encode_field(3, zlib.compress(data))
+		blob_header = encode_field(1, blob_type.encode("utf-8")) + encode_int_field(3, len(blob))
+
+		self.file.write(struct.pack(">I", len(blob_header)))
+		self.file.write(blob_header)
+		self.file.write(blob)
+
+
+	def node(self, node_id, latitude, longitude, tags):
+		'''
+		Buffer node with list of (key, value) tags. Latitude and longitude are strings.
+		'''
+
+		self.nodes.append((node_id, round(float(latitude) * 10000000), round(float(longitude) * 10000000), tags))
+		if len(self.nodes) >= pbf_block_size:
+			self.flush()
+
+
+	def flush(self):
+		'''
+		Write buffered nodes as one primitive block (granularity 100 nanodegrees, no offset).
+		'''
+
+		if not self.nodes:
+			return
+
+		strings = {"": 0}  # String index 0 is reserved as delimiter
+		keys_vals = []
+
+		for node in self.nodes:
+			for key, value in node[3]:
+				for string in (key, value):
+					if string not in strings:
+						strings[string] = len(strings)
+					keys_vals.append(strings[string])
+			keys_vals.append(0)
+
+		dense = encode_packed(1, delta([node[0] for node in self.nodes])) + \
+				encode_packed(8, delta([node[1] for node in self.nodes])) + \
+				encode_packed(9, delta([node[2] for node in self.nodes])) + \
+				encode_packed(10, keys_vals)
+
+		string_table = b"".join(encode_field(1, string.encode("utf-8")) for string in strings)
+
+		block = encode_field(1, string_table) + encode_field(2, encode_field(2, dense))
+		self.write_blob("OSMData", block)
+
+		self.nodes = []
+
+
+	def close(self):
+
+		self.flush()
+		self.file.close()
+
+
+
+class GeojsonWriter:
+	'''
+	Write nodes as point features with tags as properties to GeoJSON file.
+	'''
+
+	def __init__(self, filename, generator):
+
+		self.file = open(filename, "w", encoding="utf-8")
+		self.file.write ('{\n"type": "FeatureCollection",\n"generator": %s,\n"features": [' % json.dumps(generator))
+		self.separator = "\n"
+
+
+	def node(self, node_id, latitude, longitude, tags):
+		'''
+		Write node with list of (key, value) tags. Latitude and longitude are strings.
+		'''
+
+		feature = {
+			'type': 'Feature',
+			'id': node_id,
+			'geometry': {
+				'type': 'Point',
+				'coordinates': [ float(longitude), float(latitude) ]
+			},
+			'properties': dict(tags)
+		}
+		self.file.write (self.separator + json.dumps(feature, ensure_ascii=False))
+		self.separator = ",\n"
+
+
+	def close(self):
+
+		self.file.write ('\n]\n}\n')
+		self.file.close()
+
+
+
+class CsvWriter:
+	'''
+	Write nodes to CSV file with columns id, lat, lon and one column per tag key.
+	If list of keys is not given, rows are kept until close so that all keys are known.
+	'''
+
+	def __init__(self, filename, generator, keys=None):
+
+		self.file = open(filename, "w", newline="", encoding="utf-8")
+		self.writer = csv.writer(self.file)
+		self.keys = keys
+		self.rows = []
+
+		if keys is not None:
+			self.writer.writerow(["id", "lat", "lon"] + list(keys))
+
+
+	def node(self, node_id, latitude, longitude, tags):
+		'''
+		Write node with list of (key, value) tags. Latitude and longitude are strings.
+		'''
+
+		if self.keys is None:
+			self.rows.append((node_id, latitude, longitude, tags))
+		else:
+			values = dict(tags)
+			self.writer.writerow([node_id, latitude, longitude] + [ values.get(key, "") for key in self.keys ])
+
+
+	def close(self):
+
+		if self.keys is None:
+			self.keys = []
+			for row in self.rows:
+				for key, value in row[3]:
+					if key not in self.keys:
+						self.keys.append(key)
+			self.writer.writerow(["id", "lat", "lon"] + self.keys)
+			for row in self.rows:
+				values = dict(row[3])
+				self.writer.writerow([row[0], row[1], row[2]] + [ values.get(key, "") for key in self.keys ])
+
+		self.file.close()
+
+
+
+def open_writer(filename, generator, file_format=None, keys=None):
+	'''
+	Open writer for given file format, or for the format given by the file extension.
+	Keys gives the tag columns for CSV files (optional).
+	'''
+
+	if file_format is None:
+		file_format = get_format(filename)
+
+	if file_format == "osm":
+		return XmlWriter(filename, generator)
+	elif file_format == "gz":
+		return XmlWriter(filename, generator, compress=True)
+	elif file_format == "pbf":
+		return PbfWriter(filename, generator)
+	elif file_format == "geojson":
+		return GeojsonWriter(filename, generator)
+	elif file_format == "csv":
+		return CsvWriter(filename, generator, keys)
+	else:
+		raise ValueError("Unknown file format: '%s'" % file_format)
+
+
+
+def read_xml_nodes(file):
+	'''
+	Iterate nodes in OSM XML file object, streaming.
+	'''
+
+	root = None
+
+	for event, element in ElementTree.iterparse(file, events=("start", "end")):
+		if root is None:
+			root = element
+
+		if event == "end" and element.tag in ["node", "way", "relation"]:
+			if element.tag == "node":
+				tags = { tag.get('k'): tag.get('v') for tag in element.iterfind('tag') }
+				yield (int(element.get('id')), float(element.get('lat')), float(element.get('lon')), tags)
+			root.clear()  # Keep memory bounded
+
+
+
+def read_pbf_block(data):
+	'''
+	Iterate nodes in one PBF primitive block, including dense nodes.
+	'''
+
+	strings = []
+	groups = []
+	granularity = 100
+	lat_offset = 0
+	lon_offset = 0
+
+	for field, value in decode_fields(data):
+		if field == 1:
+			strings = [ bytes(string).decode("utf-8") for string_field, string in decode_fields(value) if string_field == 1 ]
+		elif field == 2:
+			groups.append(value)
+		elif field == 17:
+			granularity = value
+		elif field == 19:
+			lat_offset = signed(value)
+		elif field == 20:
+			lon_offset = signed(value)
+
+	for group in groups:
+		for group_field, entity in decode_fields(group):
+
+			if group_field == 1:  # Node
+				node_id = lat = lon = 0
+				keys = values = []
+				for field, value in decode_fields(entity):
+					if field == 1:
+						node_id = unzigzag(value)
+					elif field == 2:
+						keys = decode_packed(value)
+					elif field == 3:
+						values = decode_packed(value)
+					elif field == 8:
+						lat = unzigzag(value)
+					elif field == 9:
+						lon = unzigzag(value)
+				tags = { strings[key]: strings[value] for key, value in zip(keys, values) }
+				yield (node_id, (lat_offset + granularity * lat) / 1000000000, (lon_offset + granularity * lon) / 1000000000, tags)
+
+			elif group_field == 2:  # Dense nodes
+				ids = lats = lons = keys_vals = []
+				for field, value in decode_fields(entity):
+					if field == 1:
+						ids = undelta(decode_packed(value))
+					elif field == 8:
+						lats = undelta(decode_packed(value))
+					elif field == 9:
+						lons = undelta(decode_packed(value))
+					elif field == 10:
+						keys_vals = decode_packed(value)
+
+				position = 0
+				for node_id, lat, lon in zip(ids, lats, lons):
+					tags = {}
+					while position < len(keys_vals) and keys_vals[position] != 0:
+						tags[ strings[keys_vals[position]] ] = strings[keys_vals[position + 1]]
+						position += 2
+					position += 1
+					yield (node_id, (lat_offset + granularity * lat) / 1000000000, (lon_offset + granularity * lon) / 1000000000, tags)
+
+
+
+def read_pbf_nodes(file):
+	'''
+	Iterate nodes in OSM PBF file object, one block at a time.
+	Ways and relations are skipped.
+	'''
+
+	while True:
+		length = file.read(4)
+		if len(length) < 4:
+			break
+
+		blob_type = ""
+		data_size = 0
+		for field, value in decode_fields(file.read(struct.unpack(">I", length)[0])):
+			if field == 1:
+				blob_type = bytes(value).decode("utf-8")
+			elif field == 3:
+				data_size = value
+
+		data = None
+		for field, value in decode_fields(file.read(data_size)):
+			if field == 1:
+				data = bytes(value)
+			elif field == 3:
+				data = zlib.decompress(value)
+
+		if blob_type == "OSMData":
+			if data is None:
+				raise ValueError("Unsupported PBF blob compression")
+			yield from read_pbf_block(data)
+
+
+
+def read_geojson_nodes(file):
+	'''
+	Iterate point features in GeoJSON file object.
+	'''
+
+	data = json.load(file)
+	for feature in data['features']:
+		if feature['geometry']['type'] == "Point":
+			longitude, latitude = feature['geometry']['coordinates'][:2]
+			yield (feature.get('id', 0), latitude, longitude, { key: str(value) for key, value in feature['properties'].items() })
+
+
+
+def read_csv_nodes(file):
+	'''
+	Iterate rows in CSV file object produced by CsvWriter. Empty values are omitted from tags.
+	'''
+
+	for row in csv.DictReader(file):
+		node_id = int(row.pop('id'))
+		latitude = float(row.pop('lat'))
+		longitude = float(row.pop('lon'))
+		yield (node_id, latitude, longitude, { key: value for key, value in row.items() if value })
+
+
+
+def read_nodes(filename):
+	'''
+	Iterate nodes in file of any supported format, given by file extension.
+	Generates (node_id, latitude, longitude, tags) with tags as dict.
+	'''
+
+	file_format = get_format(filename)
+
+	if file_format == "geojson":
+		with open(filename, encoding="utf-8") as file:
+			yield from read_geojson_nodes(file)
+
+	elif file_format == "csv":
+		with open(filename, newline="", encoding="utf-8") as file:
+			yield from read_csv_nodes(file)
+
+	elif file_format == "pbf":
+		with open(filename, "rb") as file:
+			yield from read_pbf_nodes(file)
+
+	elif file_format == "gz":
+		with gzip.open(filename, "rb") as file:
+			yield from read_xml_nodes(file)
+
+	else:
+		with open(filename, "rb") as file:
+			yield from read_xml_nodes(file)
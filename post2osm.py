@@ -3,18 +3,56 @@
 
 # post2osm
 # Converts post offices, parcel lockers and post boxes from Posten api to osm format for import/update
-# Usage: python post2osm.py
-# Creats output files 'postkontor.osm' and 'postkasser.osm'
+# Usage: python post2osm.py [--format osm,gz,pbf,geojson,csv] [--geocode] [--replay] [--cache] [--parallel [n]]
+# Argument "--format" selects one or more output formats, separated by comma. All files are produced in one pass.
+# Argument "--replay" will load api data saved by the last run ('postkontor_api.xml', 'postkasser_api.xml') instead of downloading.
+# Argument "--cache" will reuse transformed units from last run if their raw XML is unchanged in the api (see 'post2osm_cache.json').
+# Argument "--parallel" will transform units in n worker processes (default number of CPUs). Output is the same as without.
+# Argument "--geocode" will look up coordinates for units without coordinates in local address file (see geocoder.py).
+# Creats output files 'postkontor.osm' and 'postkasser.osm' (or '.osm.gz', '.osm.pbf', '.geojson', '.csv' for the given formats)
 
 
 import html
 import sys
-import urllib.request
+import os
+import math
+import re
+import json
+import hashlib
+import concurrent.futures
 from xml.etree import ElementTree
 
+import osmfile
+import download
+import geocoder
+
 
 version = "1.2.0"
 
+output_formats = ["osm"]  # Output file formats, one or more of "osm", "gz", "pbf", "geojson" or "csv" (see osmfile.py)
+
+replay = False  # Load api data saved by last run instead of downloading (--replay)
+
+address_file = "~/Jottacloud/osm/adresser/adresser.csv"  # Kartverket address register from Geonorge (CSV), used by --geocode
+
+address_index = None  # Index of address file, opened if --geocode is given
+
+cache_file = "post2osm_cache.json"  # Cache of transformed units, used by --cache
+
+unit_cache = None  # Loaded if --cache is given
+
+cache_changed = False  # True if cache needs to be saved
+
+workers = 1  # Number of worker processes for transforming units (--parallel [n], default number of CPUs)
+
+parallel_chunk = 500  # Units per chunk sent to worker process
+
+ns = {'ns0': 'https://public.snws.posten.no/SalgsnettService.asmx/'}  # Namespace of Posten api
+
+unit_tags = re.compile(rb"<EnhetDTO[\s>]|</EnhetDTO>")  # Start and end tag of one unit in raw Posten api data
+
+cluster_radius = 10  # Meters (units closer than x meters to each other are tagged with the same CLUSTER id)
+
 
 transform_name = [
 	('MENY', 'Meny'),
@@ -55,14 +93,13 @@ def message (output_text):
 
 def make_osm_line(key,value):
 	'''
-	Produce a tag for OSM file
+	Produce a tag for OSM file (stored in list of tags for current node)
 	'''
 
 	if value != None:
-		value = html.unescape(value)
-		encoded_value = html.escape(value).strip()
-		if encoded_value:
-			file.write ('    <tag k="%s" v="%s" />\n' % (key, encoded_value))
+		value = html.unescape(value).strip()
+		if value:
+			tags.append((key, value))
 
 
 
@@ -108,288 +145,598 @@ def opening_hours(hours_csv):
 
 
 
-def process_post_offices():
+def cluster_nodes(nodes):
 	'''
-	Load post offices and parcel lockers from Posten api and produce osm file.
+	Tag units which are within cluster_radius meters of each other (or have identical coordinates) with a common CLUSTER id.
+	Uses a uniform grid with cell size equal to the radius, so only neighbour cells are compared.
+	Units without coordinates (GEOCODE) are not included.
 	'''
 
-	global file
+	grid = {}
+	points = []
+	parent = list(range(len(nodes)))
 
-	message ("\nGenerate post offices and parcel lockers ...\n")
+	def find(i):
+		while parent[i] != i:
+			parent[i] = parent[ parent[i] ]
+			i = parent[i]
+		return i
 
-	# Load api
+	# Union all pairs of units within radius, using neighbour cells in grid
 
-	url = "http://public.snws.posten.no/SalgsnettServicePublic.asmx/GetEnheterByLandkode?searchValue=&landkode=NO"
+	for i, (node_id, latitude, longitude, tags) in enumerate(nodes):
+		latitude = float(latitude)
+		if latitude < 57:
+			points.append(None)
+			continue
 
-	request = urllib.request.Request(url)
-	file = urllib.request.urlopen(request)
-	tree = ElementTree.parse(file)
-	file.close()
+		y = 6371000 * math.radians(latitude)
+		x = 6371000 * math.radians(float(longitude)) * math.cos(math.radians(latitude))
+		points.append((x, y))
 
-	ns = {'ns0': 'https://public.snws.posten.no/SalgsnettService.asmx/'}  # Namespace
+		cell = (int(x // cluster_radius), int(y // cluster_radius))
+		for dx in [-1, 0, 1]:
+			for dy in [-1, 0, 1]:
+				for j in grid.get((cell[0] + dx, cell[1] + dy), []):
+					if (points[j][0] - x)**2 + (points[j][1] - y)**2 <= cluster_radius**2:
+						parent[ find(i) ] = find(j)
 
-	root = tree.getroot()
+		grid.setdefault(cell, []).append(i)
 
-	# Produce OSM file header
+	# Tag clusters with more than one unit, numbered in file order
 
-	filename = "postkontor.osm"
-	file = open(filename, "w")
+	size = {}
+	for i in range(len(nodes)):
+		if points[i] is not None:
+			root = find(i)
+			size[root] = size.get(root, 0) + 1
 
-	file.write ('<?xml version="1.0" encoding="UTF-8"?>\n')
-	file.write ('<osm version="0.6" generator="post2osm v%s" upload="false">\n' % version)
+	cluster_ids = {}
+	count_units = 0
+	for i, node in enumerate(nodes):
+		if points[i] is not None and size[ find(i) ] > 1:
+			root = find(i)
+			if root not in cluster_ids:
+				cluster_ids[root] = len(cluster_ids) + 1
+			node[3].append(("CLUSTER", str(cluster_ids[root])))
+			count_units += 1
 
-	node_id = -1000
-	count_total = 0
-	count_lockers = 0
+	if cluster_ids:
+		message ("\t%i units in %i co-located clusters\n" % (count_units, len(cluster_ids)))
 
-	# Iterate all post offices and produce OSM tags
 
-	for office in root.iterfind('ns0:EnhetDTO', ns):
 
-		if office.find('ns0:PostnrBesoksadresse/ns0:Land/ns0:Kode', ns) != None and \
-				office.find('ns0:PostnrBesoksadresse/ns0:Land/ns0:Kode', ns).text == "NO" and \
-				office.find('ns0:Status/ns0:Navn', ns).text == "Aktiv" and \
-				office.find('ns0:EnhetsType/ns0:EnhetsType', ns).text != "36":  # Avoid pilot automats
+def save_nodes(basename, nodes):
+	'''
+	Save list of (node_id, latitude, longitude, tags) to one file for each of the selected output formats.
+	All files are written in the same pass over the nodes.
+	Returns list of file names.
+	'''
 
-			node_id -= 1
-			count_total += 1
+	keys = []  # Columns for CSV output
+	for node in nodes:
+		for key, value in node[3]:
+			if key not in keys:
+				keys.append(key)
 
-			latitude = office.find('ns0:Latitude', ns).text
-			longitude = office.find('ns0:Longitude', ns).text
-			if (latitude[0] == "-") or (longitude[0] == "-"):
-				latitude = "0"
-				longitude = "0"
+	filenames = [ osmfile.output_filename(basename, file_format) for file_format in output_formats ]
+	outputs = [ osmfile.open_writer(filename, "post2osm v%s" % version, file_format, keys)
+				for filename, file_format in zip(filenames, output_formats) ]
 
-			file.write ('  <node id="%i" lat="%s" lon="%s">\n' % (node_id, latitude, longitude))
+	for node_id, latitude, longitude, tags in nodes:
+		for output in outputs:
+			output.node(node_id, latitude, longitude, tags)
 
-			if float(latitude) < 57:
-				make_osm_line ("GEOCODE", "yes")
+	for output in outputs:
+		output.close()
 
-			make_osm_line ("ref:posten", office.find('ns0:Enhetsnr', ns).text)
-			make_osm_line ("brand", "Posten")
+	return filenames
 
-			# Get address
 
-			address = office.find('ns0:PostnrBesoksadresse', ns)
 
-			street = office.find('ns0:Besoksadresse', ns).text
-			if street != None:
-				address_line = street.strip() + ", "
-			else:
-				address_line = ""
-			address_line += address.find('ns0:Postnr', ns).text.strip() + " " + address.find('ns0:Poststed', ns).text
-
-			make_osm_line ("ADDRESS", address_line)
-#			make_osm_line ("MUNICIPALITY", address.find('ns0:Kommune', ns).text)
-#			make_osm_line ("COUNTY", address.find('ns0:Fylke', ns).text)
-			make_osm_line ("LOCATION", office.find('ns0:Beliggenhet', ns).text)			
-
-			# Adjust name and operator according to type of post office
-
-			office_type = office.find('ns0:EnhetsType/ns0:EnhetsType', ns).text
-			name = office.find('ns0:EnhetsNavn', ns).text
-			operator = office.find('ns0:Navn', ns).text
-
-			for word_from, word_to in transform_name:
-				name = name.replace(word_from, word_to)
-				operator = operator.replace(word_from, word_to)
-
-			if "kiwi" in operator.lower():
-				for number in ['0','1','2','3','4','5','6','7','8','9']:
-					operator = operator.replace(number, '')
-
-			name = name.replace("  "," ").strip()
-			operator = operator.replace("  "," ").strip()
-			alt_name = ""
-
-			# Tag according to type of post office / locker
-
-			if office_type == "21":  # Postkontor
-				operator = "Posten"
-				make_osm_line ("amenity", "post_office")
-				make_osm_line("post_office", "bureau")				
-
-			elif office_type == "1":  # Bedriftsenter
-				operator = "Posten"
-				make_osm_line ("amenity", "post_office")
-				make_osm_line("post_office", "bureau")
-
-			elif office_type == "4":  # Post i butikk
-				name = name.replace("Post i Butikk", "post i butikk")
-				alt_name = operator + " post i butikk"
-				make_osm_line ("amenity", "post_office")
-				make_osm_line("post_office", "post_annex")
-
-			elif office_type == "19":  # Pakkeutlevering
-				name = name.replace("Posten ", "")
-				alt_name = operator + " pakkeutlevering"
-				make_osm_line ("amenity", "post_office")
-				make_osm_line("post_office", "post_partner")
-
-			elif office_type == "32":  # Postpunkt (operated by Posten)
-				operator = "Posten"
-				make_osm_line ("amenity", "post_office")
-				make_osm_line("post_office", "bureau")
-
-			elif office_type == "33":  # Postpunkt
-				alt_name = operator + " postpunkt"
-				make_osm_line ("amenity", "post_office")
-				make_osm_line("post_office", "post_annex")
-
-#			elif office_type == "36":  # Pakkeautomat (not used anymore?)
-#				name = name.replace('Post i Butikk', 'post i butikk')
-#				operator = ""
-#				make_osm_line ("amenity", "parcel_locker")
-#				make_osm_line("post_office:type", "parcel_automat")
-
-			elif office_type == "37":  # Pakkeboks
-				operator = "Posten"
-				make_osm_line ("amenity", "parcel_locker")
-				count_lockers += 1
+def transform_office(office):
+	'''
+	Transform post office or parcel locker from Posten api to OSM tags.
+	Returns (latitude, longitude, address, tags), or None if the unit should not be included.
+	The GEOCODE tag is added later, after any geocoding.
+	'''
 
-			else:
-				make_osm_line ("amenity", "post_office")
-				make_osm_line ("FIXME", "Unknown type: '%s'" % office_type)
-				message ("\tUnknown type: '%s'\n" % office_type)
+	global tags
 
-			make_osm_line ("name", name)
+	if office.find('ns0:PostnrBesoksadresse/ns0:Land/ns0:Kode', ns) != None and \
+			office.find('ns0:PostnrBesoksadresse/ns0:Land/ns0:Kode', ns).text == "NO" and \
+			office.find('ns0:Status/ns0:Navn', ns).text == "Aktiv" and \
+			office.find('ns0:EnhetsType/ns0:EnhetsType', ns).text != "36":  # Avoid pilot automats
 
-			if alt_name and (alt_name != name):
-				make_osm_line ("alt_name", alt_name)
+		latitude = office.find('ns0:Latitude', ns).text
+		longitude = office.find('ns0:Longitude', ns).text
+		if (latitude[0] == "-") or (longitude[0] == "-"):
+			latitude = "0"
+			longitude = "0"
 
-			make_osm_line("operator", operator)
+		# Get address
 
-			# Opening hours
+		address = office.find('ns0:PostnrBesoksadresse', ns)
 
-			for opening in office.iterfind('ns0:Apningstider/ns0:ApningstidDTO', ns):
-				if opening.find('ns0:ApningstidType', ns) != None and opening.find('ns0:ApningstidType', ns).text == "1000":
-					hours = opening.find('ns0:ApningstidCSV', ns).text
-#					make_osm_line("HOURS", "%s" % hours)
-					make_osm_line("opening_hours", opening_hours(hours))
-					break
+		street = office.find('ns0:Besoksadresse', ns).text
+		if street != None:
+			address_line = street.strip() + ", "
+		else:
+			address_line = ""
+		address_line += address.find('ns0:Postnr', ns).text.strip() + " " + address.find('ns0:Poststed', ns).text
 
-			# Wheelchair (data not complete)
+		tags = []
 
-#			for service in office.iterfind('ns0:Tjenester/ns0:TjenesteDTO', ns):
-#				if "rullestol" in service.find('ns0:Navn', ns).text:
-#					make_osm_line ("wheelchair", "yes")
+		make_osm_line ("ref:posten", office.find('ns0:Enhetsnr', ns).text)
+		make_osm_line ("brand", "Posten")
 
-			file.write ('  </node>\n')
+		make_osm_line ("ADDRESS", address_line)
+#		make_osm_line ("MUNICIPALITY", address.find('ns0:Kommune', ns).text)
+#		make_osm_line ("COUNTY", address.find('ns0:Fylke', ns).text)
+		make_osm_line ("LOCATION", office.find('ns0:Beliggenhet', ns).text)			
 
-	# Wrap up
+		# Adjust name and operator according to type of post office
 
-	file.write ('</osm>\n')
-	file.close()
+		office_type = office.find('ns0:EnhetsType/ns0:EnhetsType', ns).text
+		name = office.find('ns0:EnhetsNavn', ns).text
+		operator = office.find('ns0:Navn', ns).text
 
-	message ("\t%i post offices and %i parcel lockers saved to '%s'\n" % (count_total - count_lockers, count_lockers, filename))
+		for word_from, word_to in transform_name:
+			name = name.replace(word_from, word_to)
+			operator = operator.replace(word_from, word_to)
 
+		if "kiwi" in operator.lower():
+			for number in ['0','1','2','3','4','5','6','7','8','9']:
+				operator = operator.replace(number, '')
 
+		name = name.replace("  "," ").strip()
+		operator = operator.replace("  "," ").strip()
+		alt_name = ""
 
-def process_mailbox():
+		# Tag according to type of post office / locker
+
+		if office_type == "21":  # Postkontor
+			operator = "Posten"
+			make_osm_line ("amenity", "post_office")
+			make_osm_line("post_office", "bureau")				
+
+		elif office_type == "1":  # Bedriftsenter
+			operator = "Posten"
+			make_osm_line ("amenity", "post_office")
+			make_osm_line("post_office", "bureau")
+
+		elif office_type == "4":  # Post i butikk
+			name = name.replace("Post i Butikk", "post i butikk")
+			alt_name = operator + " post i butikk"
+			make_osm_line ("amenity", "post_office")
+			make_osm_line("post_office", "post_annex")
+
+		elif office_type == "19":  # Pakkeutlevering
+			name = name.replace("Posten ", "")
+			alt_name = operator + " pakkeutlevering"
+			make_osm_line ("amenity", "post_office")
+			make_osm_line("post_office", "post_partner")
+
+		elif office_type == "32":  # Postpunkt (operated by Posten)
+			operator = "Posten"
+			make_osm_line ("amenity", "post_office")
+			make_osm_line("post_office", "bureau")
+
+		elif office_type == "33":  # Postpunkt
+			alt_name = operator + " postpunkt"
+			make_osm_line ("amenity", "post_office")
+			make_osm_line("post_office", "post_annex")
+
+#		elif office_type == "36":  # Pakkeautomat (not used anymore?)
+#			name = name.replace('Post i Butikk', 'post i butikk')
+#			operator = ""
+#			make_osm_line ("amenity", "parcel_locker")
+#			make_osm_line("post_office:type", "parcel_automat")
+
+		elif office_type == "37":  # Pakkeboks
+			operator = "Posten"
+			make_osm_line ("amenity", "parcel_locker")
+
+		else:
+			make_osm_line ("amenity", "post_office")
+			make_osm_line ("FIXME", "Unknown type: '%s'" % office_type)
+			message ("\tUnknown type: '%s'\n" % office_type)
+
+		make_osm_line ("name", name)
+
+		if alt_name and (alt_name != name):
+			make_osm_line ("alt_name", alt_name)
+
+		make_osm_line("operator", operator)
+
+		# Opening hours
+
+		for opening in office.iterfind('ns0:Apningstider/ns0:ApningstidDTO', ns):
+			if opening.find('ns0:ApningstidType', ns) != None and opening.find('ns0:ApningstidType', ns).text == "1000":
+				hours = opening.find('ns0:ApningstidCSV', ns).text
+#				make_osm_line("HOURS", "%s" % hours)
+				make_osm_line("opening_hours", opening_hours(hours))
+				break
+
+		# Wheelchair (data not complete)
+
+#		for service in office.iterfind('ns0:Tjenester/ns0:TjenesteDTO', ns):
+#			if "rullestol" in service.find('ns0:Navn', ns).text:
+#				make_osm_line ("wheelchair", "yes")
+
+		return (latitude, longitude, address_line, tags)
+
+	else:
+		return None
+
+
+
+def transform_box(box):
 	'''
-	Load post boxes from Posten api and produce osm file.
+	Transform post box from Posten api to OSM tags.
+	Returns (latitude, longitude, address, tags), or None if the unit should not be included.
+	The GEOCODE tag is added later, after any geocoding.
 	'''
 
-	global file
+	global tags
 
-	message ("Generate mail boxes ...\n")
+	if box.find('ns0:PostnrBesoksadresse/ns0:Land/ns0:Kode', ns) != None and \
+			box.find('ns0:Status/ns0:Navn', ns).text == "Aktiv":
 
-	# Load api
+		latitude = box.find('ns0:Latitude', ns).text
+		longitude = box.find('ns0:Longitude', ns).text
+		if (latitude[0] == "-") or (longitude[0] == "-"):
+			latitude = "0"
+			longitude = "0"
 
-	url = "http://public.snws.posten.no/SalgsnettServicePublic.asmx/GetInnleveringspostkasser?searchValue="
+		# Get address
 
-	request = urllib.request.Request(url)
-	file = urllib.request.urlopen(request)
-	tree = ElementTree.parse(file)
-	file.close()
+		address = box.find('ns0:PostnrBesoksadresse', ns)
 
-	ns = {'ns0': 'https://public.snws.posten.no/SalgsnettService.asmx/'}  # Namespace
+		street = box.find('ns0:Besoksadresse', ns).text
+		if street != None:
+			address_line = street.strip() + ", "
+		else:
+			address_line = ""
+		address_line += address.find('ns0:Postnr', ns).text.strip() + " " + address.find('ns0:Poststed', ns).text
 
-	root = tree.getroot()
+		tags = []
 
-	# Produce OSM file header
+		make_osm_line ("amenity", "post_box")
+		make_osm_line ("ref:posten_box", box.find('ns0:Enhetsnr', ns).text)
+		make_osm_line ("brand", "Posten")
 
-	filename = "postkasser.osm"
-	file = open(filename, "w")
+#		operator = box.find('ns0:ConnectedOffice/ns0:EnhetsNavn', ns)  # Responsible post office (data not complete)
+#		if operator != None:
+#			make_osm_line ("operator", operator.text)
 
-	file.write ('<?xml version="1.0" encoding="UTF-8"?>\n')
-	file.write ('<osm version="0.6" generator="post2osm v%s" upload="false">\n' % version)
+		make_osm_line ("ADDRESS", address_line)
+		make_osm_line ("MUNICIPALITY", address.find('ns0:Kommune', ns).text)
+#		make_osm_line ("COUNTY", address.find('ns0:Fylke', ns).text)
+		make_osm_line ("LOCATION", box.find('ns0:Beliggenhet', ns).text)	
 
-	node_id = -1000
-	count = 0
+		# Get collection time
 
-	# Iterate all mail boxes and produce OSM tags
+		if box.find('ns0:Frister', ns):
+			collection = box.find('ns0:Frister/ns0:FristDTO', ns)
+			hours = collection.find("ns0:Periode", ns).text + " " + collection.find('ns0:Klokkeslett', ns).text
+			make_osm_line ("collection_times", opening_hours(hours))
 
-	for box in root.iterfind('ns0:EnhetDTO', ns):
+		# Discover any new box type
 
-		if box.find('ns0:PostnrBesoksadresse/ns0:Land/ns0:Kode', ns) != None and \
-				box.find('ns0:Status/ns0:Navn', ns).text == "Aktiv":
+		box_type = box.find('ns0:EnhetsType/ns0:EnhetsType', ns).text
+		if box_type != "10":  # Post box
+			make_osm_line ("FIXME", "Unknown type: '%s'" % box_type)
+			message ("\tUnknown type: '%s'\n" % box_type)
 
-			node_id -= 1
-			count += 1
+		return (latitude, longitude, address_line, tags)
+
+	else:
+		return None
+
+
+
+def load_cache():
+	'''
+	Load cache of transformed units from last run.
+	The cache is discarded if this script has been changed since the cache was saved, or if the cache file is unreadable.
+	'''
 
-			latitude = box.find('ns0:Latitude', ns).text
-			longitude = box.find('ns0:Longitude', ns).text
-			if (latitude[0] == "-") or (longitude[0] == "-"):
-				latitude = "0"
-				longitude = "0"
+	global unit_cache
 
-			file.write ('  <node id="%i" lat="%s" lon="%s">\n' % (node_id, latitude, longitude))
+	with open(__file__, "rb") as file:
+		code = hashlib.sha1(file.read()).hexdigest()
 
-			if float(latitude) < 57:
-				make_osm_line ("GEOCODE", "yes")
+	unit_cache = { 'code': code }
 
-			make_osm_line ("amenity", "post_box")
-			make_osm_line ("ref:posten_box", box.find('ns0:Enhetsnr', ns).text)
-			make_osm_line ("brand", "Posten")
+	if os.path.isfile(cache_file):
+		try:
+			with open(cache_file, encoding="utf-8") as file:
+				data = json.load(file)
+		except ValueError:
+			message ("\tCache file '%s' is unreadable and will be rebuilt\n" % cache_file)
+			data = {}
 
-#			operator = box.find('ns0:ConnectedOffice/ns0:EnhetsNavn', ns)  # Responsible post office (data not complete)
-#			if operator != None:
-#				make_osm_line ("operator", operator.text)
+		if isinstance(data, dict) and data.get('code', None) == code:
+			unit_cache = data
 
-			# Get address
 
-			address = box.find('ns0:PostnrBesoksadresse', ns)
 
-			street = box.find('ns0:Besoksadresse', ns).text
-			if street != None:
-				address_line = street.strip() + ", "
+def save_cache():
+	'''
+	Save cache of transformed units for next run.
+	The cache is written to a temporary file first, so that an interrupted run does not leave a truncated cache.
+	'''
+
+	with open(cache_file + ".tmp", "w", encoding="utf-8") as file:
+		file.write(json.dumps(unit_cache, ensure_ascii=False))
+
+	os.replace(cache_file + ".tmp", cache_file)
+
+
+
+def split_units(data):
+	'''
+	Find byte range of each unit in raw api data, without parsing it.
+	Returns header before first unit, footer after last unit and list of (start, end) byte ranges of units.
+	'''
+
+	ranges = []
+	for match in unit_tags.finditer(data):
+		if match.group().startswith(b"</"):
+			ranges.append((start, match.end()))
+		else:
+			start = match.start()
+
+	if not ranges:
+		return (data, b"", [])
+
+	return (data[ : ranges[0][0] ], data[ ranges[-1][1] : ], ranges)
+
+
+
+def parse_units(header, footer, raw_units):
+	'''
+	Parse list of raw units, wrapped in header and footer from api data to get the namespace.
+	Returns list of unit elements.
+	'''
+
+	return list(ElementTree.fromstring(header + b"".join(raw_units) + footer))
+
+
+
+def transform_chunk(transform, filename, header, footer, ranges):
+	'''
+	Transform chunk of units given as byte ranges of api file. Runs in worker process.
+	'''
+
+	raw_units = []
+	with open(filename, "rb") as file:
+		for start, end in ranges:
+			file.seek(start)
+			raw_units.append(file.read(end - start))
+
+	return [ transform(unit) for unit in parse_units(header, footer, raw_units) ]
+
+
+
+def transform_units(filename, data, transform, cache_name):
+	'''
+	Transform all units in raw api data with given transform function. The data must also be saved in the given api file.
+	If cache is used (--cache), units with unchanged raw XML since last run are taken from cache, by digest of the raw XML.
+	If workers is more than 1 (--parallel), the remaining units are transformed in chunks in a process pool.
+	Each worker gets byte ranges of the api file and reads and parses its own units.
+	Returns list of results in the same order as in the api data.
+	'''
+
+	global cache_changed
+
+	if unit_cache is None and workers == 1:
+		root = ElementTree.fromstring(data)
+		return [ transform(unit) for unit in root.findall('ns0:EnhetDTO', ns) ]
+
+	header, footer, ranges = split_units(data)
+	results = [ None ] * len(ranges)
+	pending = list(range(len(ranges)))  # Units to be transformed
+
+	# Get unchanged units from cache
+
+	if unit_cache is not None:
+		old_cache = unit_cache.get(cache_name, {})
+		digests = [ hashlib.sha1(data[ start : end ]).hexdigest() for start, end in ranges ]
+		pending = []
+
+		for i, digest in enumerate(digests):
+			if digest in old_cache:
+				result = old_cache[digest]
+				if result is not None:
+					result = (result[0], result[1], result[2], [ tuple(tag) for tag in result[3] ])
+					for key, value in result[3]:
+						if key == "FIXME":
+							message ("\t%s\n" % value)  # Repeat warning from transform
+				results[i] = result
 			else:
-				address_line = ""
-			address_line += address.find('ns0:Postnr', ns).text.strip() + " " + address.find('ns0:Poststed', ns).text
+				pending.append(i)
+
+		count_hits = len(ranges) - len(pending)
+		message ("\t%i of %i units from cache (%i%% hit rate)\n" % (count_hits, len(ranges), 100 * count_hits / max(len(ranges), 1)))
+
+	# Transform new and changed units, in chunks in parallel or all at once
+
+	transformed = []
+
+	if workers > 1 and len(pending) > parallel_chunk:
+		chunks = [ [ ranges[i] for i in pending[ j : j + parallel_chunk ] ] for j in range(0, len(pending), parallel_chunk) ]
+
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+			futures = [ executor.submit(transform_chunk, transform, filename, header, footer, chunk) for chunk in chunks ]
+			transformed = [ result for future in futures for result in future.result() ]
+
+	elif pending:
+		transformed = [ transform(unit) for unit in parse_units(header, footer, [ data[ ranges[i][0] : ranges[i][1] ] for i in pending ]) ]
+
+	for i, result in zip(pending, transformed):
+		results[i] = result
+
+	# Update cache with units from this run. Only saved if any unit has been changed, added or removed.
+
+	if unit_cache is not None:
+		new_cache = dict(zip(digests, results))
+		if pending or len(new_cache) != len(old_cache):
+			unit_cache[cache_name] = new_cache
+			cache_changed = True
+
+	return results
+
+
+
+def make_node(node_id, unit):
+	'''
+	Produce node from transformed unit, with geocoding from address file if no coordinates (--geocode).
+	Returns node and whether it was geocoded.
+	'''
+
+	latitude, longitude, address_line, tags = unit
+	geocoded = False
+
+	# Geocode from local address file if no coordinates
+
+	if float(latitude) < 57 and address_index is not None:
+		coordinates = geocoder.lookup(address_index, address_line)
+		if coordinates is not None:
+			latitude = "%.7f" % coordinates[0]
+			longitude = "%.7f" % coordinates[1]
+			geocoded = True
+
+	if float(latitude) < 57:
+		tags = [("GEOCODE", "yes")] + tags
+	else:
+		tags = list(tags)
+
+	return ((node_id, latitude, longitude, tags), geocoded)
+
+
+
+def process_post_offices():
+	'''
+	Load post offices and parcel lockers from Posten api and produce osm file.
+	'''
+
+	message ("\nGenerate post offices and parcel lockers ...\n")
+
+	# Load api
+
+	url = "http://public.snws.posten.no/SalgsnettServicePublic.asmx/GetEnheterByLandkode?searchValue=&landkode=NO"
+
+	with download.open_url(url, "postkontor_api.xml", replay) as file:
+		data = file.read()
+
+	nodes = []
+	node_id = -1000
+	count_total = 0
+	count_lockers = 0
+	count_geocoded = 0
+
+	# Iterate all post offices and produce OSM tags
+
+	for unit in transform_units("postkontor_api.xml", data, transform_office, "postkontor"):
+		if unit is not None:
+			node_id -= 1
+			count_total += 1
+
+			node, geocoded = make_node(node_id, unit)
+			nodes.append(node)
+
+			if geocoded:
+				count_geocoded += 1
+			if ("amenity", "parcel_locker") in node[3]:
+				count_lockers += 1
+
+	# Flag co-located units and save file
+
+	cluster_nodes(nodes)
+
+	filenames = save_nodes("postkontor", nodes)
+
+	if address_index is not None:
+		message ("\t%i post offices and parcel lockers geocoded from address file\n" % count_geocoded)
+
+	message ("\t%i post offices and %i parcel lockers saved to '%s'\n" % (count_total - count_lockers, count_lockers, "', '".join(filenames)))
+
+
+
+def process_mailbox():
+	'''
+	Load post boxes from Posten api and produce osm file.
+	'''
 
-			make_osm_line ("ADDRESS", address_line)
-			make_osm_line ("MUNICIPALITY", address.find('ns0:Kommune', ns).text)
-#			make_osm_line ("COUNTY", address.find('ns0:Fylke', ns).text)
-			make_osm_line ("LOCATION", box.find('ns0:Beliggenhet', ns).text)	
+	message ("Generate mail boxes ...\n")
+
+	# Load api
 
-			# Get collection time
+	url = "http://public.snws.posten.no/SalgsnettServicePublic.asmx/GetInnleveringspostkasser?searchValue="
 
-			if box.find('ns0:Frister', ns):
-				collection = box.find('ns0:Frister/ns0:FristDTO', ns)
-				hours = collection.find("ns0:Periode", ns).text + " " + collection.find('ns0:Klokkeslett', ns).text
-				make_osm_line ("collection_times", opening_hours(hours))
+	with download.open_url(url, "postkasser_api.xml", replay) as file:
+		data = file.read()
 
-			# Discover any new box type
+	nodes = []
+	node_id = -1000
+	count = 0
+	count_geocoded = 0
 
-			box_type = box.find('ns0:EnhetsType/ns0:EnhetsType', ns).text
-			if box_type != "10":  # Post box
-				make_osm_line ("FIXME", "Unknown type: '%s'" % box_type)
-				message ("\tUnknown type: '%s'\n" % box_type)
+	# Iterate all mail boxes and produce OSM tags
 
-			file.write ('  </node>\n')
+	for unit in transform_units("postkasser_api.xml", data, transform_box, "postkasser"):
+		if unit is not None:
+			node_id -= 1
+			count += 1
 
-	# Wrap up
+			node, geocoded = make_node(node_id, unit)
+			nodes.append(node)
 
-	file.write ('</osm>\n')
-	file.close()
+			if geocoded:
+				count_geocoded += 1
 
-	message ("\t%i post boxes saved to '%s'\n\n" % (count, filename))
+	# Flag co-located units and save file
+
+	cluster_nodes(nodes)
+
+	filenames = save_nodes("postkasser", nodes)
+
+	if address_index is not None:
+		message ("\t%i post boxes geocoded from address file\n" % count_geocoded)
+
+	message ("\t%i post boxes saved to '%s'\n\n" % (count, "', '".join(filenames)))
 
 
 
 # Main program
 
 if __name__ == '__main__':
+
+	if "--format" in sys.argv and sys.argv.index("--format") + 1 < len(sys.argv):
+		output_formats = list(dict.fromkeys(sys.argv[sys.argv.index("--format") + 1].split(",")))  # Without duplicates
+		for file_format in output_formats:
+			if file_format not in osmfile.file_formats:
+				sys.exit("Unknown format '%s', use one or more of: %s" % (file_format, ",".join(osmfile.file_formats)))
+
+	replay = "--replay" in sys.argv
+
+	if "--geocode" in sys.argv:
+		address_index = geocoder.open_index(address_file)
+
+	if "--parallel" in sys.argv:
+		index = sys.argv.index("--parallel")
+		if index + 1 < len(sys.argv) and sys.argv[index + 1].isdigit():
+			workers = int(sys.argv[index + 1])
+		else:
+			workers = os.cpu_count() or 1
+
+	if "--cache" in sys.argv:
+		load_cache()
+
 	process_post_offices()
 	process_mailbox()
+
+	if cache_changed:
+		save_cache()
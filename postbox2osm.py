@@ -3,8 +3,11 @@
 
 # post2osm
 # Converts post boxes from Posten api to osm format for import/update
-# Usage: python post2osm.py [-api]
+# Usage: python post2osm.py [-api] [--format osm,gz,pbf,geojson,csv] [--geocode] [--replay]
+# Argument "--replay" will load api data saved by the last run ('kommuner_api.json', 'postkasser_api.xml') instead of downloading.
 # Argument "-api" will load post boxes from Posten APi, otherwise loads from file postkasser.osm.
+# Argument "--geocode" will look up coordinates for post boxes without coordinates in local address file (see geocoder.py).
+# Argument "--format" selects one or more output formats, separated by comma. The first format is also used for the input file from post2osm.py.
 # Creats output files postkasser_vegg.osm'
 
 
@@ -13,9 +16,14 @@ import sys
 import os
 import json
 import math
-import urllib.request
+import queue
+import threading
 from xml.etree import ElementTree
 
+import osmfile
+import download
+import geocoder
+
 
 version = "1.0.0"
 
@@ -25,6 +33,16 @@ wall_threshold = 5  # Meters (post boxes only relocated if less than x meters fr
 
 wall_offset = 1  # Meters (post boxes relocated x meters ouside of closest wall)
 
+prepared_vertices = 100  # Buildings with more than x vertices get an edge index on first use (faster for large buildings)
+
+prefetch_files = 2  # Number of building files loaded ahead in background while post boxes are being relocated
+
+output_formats = ["osm"]  # File formats, one or more of "osm", "gz", "pbf", "geojson" or "csv" (see osmfile.py)
+
+replay = False  # Load api data saved by last run instead of downloading (--replay)
+
+address_file = "~/Jottacloud/osm/adresser/adresser.csv"  # Kartverket address register from Geonorge (CSV), used by --geocode
+
 
 
 def message (output_text):
@@ -96,7 +114,7 @@ def line_distance(s1, s2, p3, offset):
 
 
 
-def closest_line(point, polygon):
+def closest_line(point, polygon, offset):
 	'''
 	Get closest point on polygon, including multipolygons.
 	'''
@@ -106,7 +124,7 @@ def closest_line(point, polygon):
 
 	for patch in polygon:
 		for i in range(1, len(patch)):
-			new_point, dist = line_distance(patch[i-1], patch[i], point, wall_offset)
+			new_point, dist = line_distance(patch[i-1], patch[i], point, offset)
 			if dist < best_distance:
 				best_distance = dist
 				best_point = new_point
@@ -152,9 +170,8 @@ def load_municipalities():
 	'''
 
 	url = "https://ws.geonorge.no/kommuneinfo/v1/fylkerkommuner?filtrer=fylkesnummer%2Cfylkesnavn%2Ckommuner.kommunenummer%2Ckommuner.kommunenavnNorsk"
-	file = urllib.request.urlopen(url)
-	data = json.load(file)
-	file.close()
+	with download.open_url(url, "kommuner_api.json", replay) as file:
+		data = json.load(file)
 	for county in data:
 		for municipality in county['kommuner']:
 			entry = {
@@ -166,29 +183,15 @@ def load_municipalities():
 
 
 
-def get_tag(node, tag):
-	'''
-	Get value of tag from XML.
-	'''
-
-	t = node.find("tag[@k='%s']" % tag)
-	if t is not None:
-		return t.get('v')
-	else:
-		return None
-
-
-
 def make_osm_line(key,value):
 	'''
-	Produce a tag for OSM file
+	Produce a tag for OSM file (stored in list of tags for current node)
 	'''
 
 	if value != None:
-		value = html.unescape(value)
-		encoded_value = html.escape(value).strip()
-		if encoded_value:
-			file.write ('    <tag k="%s" v="%s" />\n' % (key, encoded_value))
+		value = html.unescape(value).strip()
+		if value:
+			tags.append((key, value))
 
 
 
@@ -235,30 +238,23 @@ def opening_hours(hours_csv):
 
 
 
-def load_mailbox_file():
+def load_mailbox_file(filename):
 	'''
 	Load post boxes from OSM file produced by post2osm.py and store in list.
+	File format is given by file extension (see osmfile.py).
 	'''
 
-	message ("Load mail boxes from OSM file ...\n")
+	message ("Load mail boxes from OSM file '%s' ...\n" % filename)
 
-	file = open("postkasser.osm")
-	tree = ElementTree.parse(file)
-	file.close()
+	for node_id, latitude, longitude, node_tags in osmfile.read_nodes(filename):
 
-	root = tree.getroot()
-	for node in root:
-
-		latitude = float(node.attrib['lat'])
-		longitude = float(node.attrib['lon'])
-		
 		entry = {
-			'ref':			get_tag(node,'ref:posten_box'),
+			'ref':			node_tags.get('ref:posten_box', None),
 			'point':		(longitude, latitude),
-			'address':		get_tag(node, 'ADDRESS'),
-			'municipality':	get_tag(node, 'MUNICIPALITY'),
-			'location':		get_tag(node, 'LOCATION'),
-			'collection':	get_tag(node, 'collection_times')
+			'address':		node_tags.get('ADDRESS', None),
+			'municipality':	node_tags.get('MUNICIPALITY', None),
+			'location':		node_tags.get('LOCATION', None),
+			'collection':	node_tags.get('collection_times', None)
 		}
 		post_boxes.append(entry)
 
@@ -277,15 +273,11 @@ def load_mailbox_api():
 
 	url = "http://public.snws.posten.no/SalgsnettServicePublic.asmx/GetInnleveringspostkasser?searchValue="
 
-	request = urllib.request.Request(url)
-	file = urllib.request.urlopen(request)
-	tree = ElementTree.parse(file)
-	file.close()
+	with download.open_url(url, "postkasser_api.xml", replay) as file:
+		root = ElementTree.fromstring(file.read())  # Read all data at once, so that download may be restarted
 
 	ns = {'ns0': 'https://public.snws.posten.no/SalgsnettService.asmx/'}  # Namespace
 
-	root = tree.getroot()
-
 	# Iterate all mail boxes and produce OSM tags
 
 	for box in root.iterfind('ns0:EnhetDTO', ns):
@@ -348,6 +340,276 @@ def load_mailbox_api():
 
 
 
+def geocode_mailbox():
+	'''
+	Look up coordinates in local address file for post boxes without coordinates from Posten.
+	'''
+
+	message ("Geocode post boxes from address file ...\n")
+
+	address_index = geocoder.open_index(address_file)
+
+	count = 0
+	count_geocoded = 0
+
+	for box in post_boxes:
+		if box['point'][1] < 57 and box['address']:
+			count += 1
+			coordinates = geocoder.lookup(address_index, box['address'])
+			if coordinates is not None:
+				box['point'] = (coordinates[1], coordinates[0])
+				count_geocoded += 1
+
+	address_index.close()
+
+	message ("\t%i of %i post boxes geocoded\n" % (count_geocoded, count))
+
+
+
+def index_buildings(features):
+	'''
+	Build list of building polygons with bbox from GeoJSON features (used for filtering in relocate).
+	Only buildings with polygon geometry are included.
+	'''
+
+	buildings = []
+
+	for feature in features:
+		if feature['geometry']['type'] == "Polygon":
+			polygon = feature['geometry']['coordinates']
+			building = {
+				'polygon':	polygon,
+				'min_bbox':	(min([ node[0] for node in polygon[0] ]), min([ node[1] for node in polygon[0] ])),
+				'max_bbox':	(max([ node[0] for node in polygon[0] ]), max([ node[1] for node in polygon[0] ]))
+			}
+			buildings.append(building)
+
+	return buildings
+
+
+
+def prepare_building(building):
+	'''
+	Build edge index for building with many vertices, used by inside_building_polygon() and closest_building_line().
+	Outer ring edges are put in horizontal bands (slabs) covering their y-range, so a point test only visits
+	the edges of one band. All edges, including inner rings, are put in a uniform grid for nearest edge search.
+	'''
+
+	ring = building['polygon'][0]
+	min_x, min_y = building['min_bbox']
+	max_x, max_y = building['max_bbox']
+
+	# Horizontal bands for point in polygon test (edges kept in same order and direction as in inside_polygon)
+
+	band_count = max(1, len(ring) // 4)
+	band_height = (max_y - min_y) / band_count or 1
+	bands = [ [] for i in range(band_count) ]
+
+	for i in range(1, len(ring)):
+		p1x, p1y = ring[i-1]
+		p2x, p2y = ring[i]
+		first = min(int((min(p1y, p2y) - min_y) / band_height), band_count - 1)
+		last = min(int((max(p1y, p2y) - min_y) / band_height), band_count - 1)
+		for band in range(first, last + 1):
+			bands[band].append((p1x, p1y, p2x, p2y))
+
+	# Grid of segments for nearest edge search, with longitude scaled to approximately square cells
+
+	scale = math.cos(math.radians((min_y + max_y) / 2))
+	segments = []
+	for patch in building['polygon']:
+		for i in range(1, len(patch)):
+			segments.append((patch[i-1], patch[i]))
+
+	width = (max_x - min_x) * scale
+	height = max_y - min_y
+	cell_size = max(math.sqrt(width * height / len(segments)), max(width, height) / len(segments), 1e-7)
+	columns = int(width / cell_size) + 1
+	rows = int(height / cell_size) + 1
+
+	grid = {}
+	for index, (s1, s2) in enumerate(segments):
+		first_column = int((min(s1[0], s2[0]) - min_x) * scale / cell_size)
+		last_column = int((max(s1[0], s2[0]) - min_x) * scale / cell_size)
+		first_row = int((min(s1[1], s2[1]) - min_y) / cell_size)
+		last_row = int((max(s1[1], s2[1]) - min_y) / cell_size)
+		for column in range(first_column, last_column + 1):
+			for row in range(first_row, last_row + 1):
+				grid.setdefault((column, row), []).append(index)
+
+	building['prepared'] = {
+		'closed':		ring[0] == ring[-1],
+		'bands':		bands,
+		'band_height':	band_height,
+		'segments':		segments,
+		'grid':			grid,
+		'scale':		scale,
+		'cell_size':	cell_size,
+		'size':			max(columns, rows)
+	}
+
+
+
+def inside_building_polygon(point, building):
+	'''
+	Tests whether point is inside outer ring of building.
+	Same result as inside_polygon(), but uses edge index for buildings with many vertices.
+	'''
+
+	if len(building['polygon'][0]) <= prepared_vertices:
+		return inside_polygon(point, building['polygon'][0])
+
+	if "prepared" not in building:
+		prepare_building(building)
+
+	prepared = building['prepared']
+	if not prepared['closed']:
+		return None
+
+	x, y = point
+	min_y = building['min_bbox'][1]
+	if not building['min_bbox'][1] <= y <= building['max_bbox'][1]:
+		return False
+
+	band = min(int((y - min_y) / prepared['band_height']), len(prepared['bands']) - 1)
+	inside = False
+
+	for p1x, p1y, p2x, p2y in prepared['bands'][band]:
+		if min(p1y, p2y) < y <= max(p1y, p2y) and x <= max(p1x, p2x):
+			xints = (y-p1y) * (p2x-p1x) / (p2y-p1y) + p1x
+			if p1x == p2x or x <= xints:
+				inside = not inside
+
+	return inside
+
+
+
+def closest_building_line(point, building, offset):
+	'''
+	Get closest point on building outline, including inner rings.
+	Same result as closest_line(), but uses edge index for buildings with many vertices.
+	Grid cells are searched in growing squares around the point until no closer edge is possible.
+	'''
+
+	if len(building['polygon'][0]) <= prepared_vertices:
+		return closest_line(point, building['polygon'], offset)
+
+	if "prepared" not in building:
+		prepare_building(building)
+
+	prepared = building['prepared']
+	segments = prepared['segments']
+	cell_size = prepared['cell_size']
+	cell_meters = 0.9 * math.radians(cell_size) * 6371000  # Conservative, allows for simplified reprojection
+
+	column = int((point[0] - building['min_bbox'][0]) * prepared['scale'] / cell_size)
+	row = int((point[1] - building['min_bbox'][1]) / cell_size)
+
+	best_distance = 99999
+	best_point = None
+	best_index = None
+	visited = set()
+
+	for radius in range(prepared['size'] + 1):
+
+		# No unvisited edge can be closer than the distance to the edge of the visited square
+
+		if best_point is not None and (radius - 1) * cell_meters > best_distance:
+			break
+
+		candidates = []
+		for c in range(column - radius, column + radius + 1):
+			for r in range(row - radius, row + radius + 1):
+				if max(abs(c - column), abs(r - row)) == radius:
+					for index in prepared['grid'].get((c, r), []):
+						if index not in visited:
+							visited.add(index)
+							candidates.append(index)
+
+		for index in sorted(candidates):
+			new_point, dist = line_distance(segments[index][0], segments[index][1], point, offset)
+			if dist < best_distance or (dist == best_distance and best_index is not None and index < best_index):
+				best_distance = dist
+				best_point = new_point
+				best_index = index
+
+	return (best_point, best_distance)
+
+
+
+def inside_building(point, buildings):
+	'''
+	Return first building which point is inside, or None.
+	'''
+
+	for building in buildings:
+		if building['min_bbox'][0] < point[0] < building['max_bbox'][0] and \
+				building['min_bbox'][1] < point[1] < building['max_bbox'][1] and \
+				inside_building_polygon(point, building):
+			return building
+
+	return None
+
+
+
+def relocate(points, buildings, threshold, offset):
+	'''
+	Relocate points which are inside a building to outside of the closest wall.
+	Points are (lon, lat) tuples and buildings is a list produced by index_buildings().
+	If distance to the closest wall is less than threshold meters, the point is moved offset meters outside of the wall,
+	unless the new point is inside another building.
+	Returns list of (point, distance, moved) for each input point, in the same order.
+	Distance is None if the point is not inside any building.
+	'''
+
+	results = []
+
+	for original_point in points:
+
+		result_point = original_point
+		result_distance = None
+		moved = False
+
+		# Check if point is inside a building
+
+		for building in buildings:
+
+			if building['min_bbox'][0] < original_point[0] < building['max_bbox'][0] and \
+					building['min_bbox'][1] < original_point[1] < building['max_bbox'][1] and \
+					inside_building_polygon(original_point, building):
+
+				point, distance = closest_building_line(original_point, building, offset)
+				result_distance = distance
+
+				# Check if new point is inside another building (if so, abort the relocation)
+
+				if distance < threshold and inside_building(point, buildings) is None:
+					result_point = point
+					moved = True
+					break
+
+		results.append((result_point, result_distance, moved))
+
+	return results
+
+
+
+def load_building_files(file_paths, building_queue):
+	'''
+	Load building files in given order and put (data, error) for each file into queue, so that the consumer never waits for a file which failed.
+	Runs in background thread. The queue size limits how many decoded files are kept in memory ahead of use.
+	'''
+
+	for file_path in file_paths:
+		try:
+			with open(file_path) as file:
+				data = json.load(file)
+			building_queue.put((data, None))
+		except Exception as error:  # Any error is raised by consumer, e.g. RecursionError or MemoryError from json
+			building_queue.put((None, error))
+
+
+
 def check_mailbox():
 	'''
 	Check if mailbox should be relocated outside of building.
@@ -363,11 +625,22 @@ def check_mailbox():
 
 	message("Moving post boxes to closest wall ...\n")
 
+	# Start loading building files in background, in the same order as municipalities are processed
+
+	file_paths = []
+	for municipality in municipalities:
+		filename = "bygninger_%s_%s.geojson" % (municipality['ref'], municipality['name'].replace(" ", "_"))
+		file_paths.append(os.path.expanduser(import_folder + filename))
+
+	building_queue = queue.Queue(maxsize=prefetch_files)
+	thread = threading.Thread(target=load_building_files, args=(file_paths, building_queue), daemon=True)
+	thread.start()
+
 	total_moved = 0
 
 	for municipality in municipalities:
 
-		# Load building file for municipality
+		# Get building file for municipality from background loader
 
 		message ("\t%-20s" % municipality['name'])
 
@@ -375,70 +648,34 @@ def check_mailbox():
 		if municipality['name'] in ['Våler', 'Herøy']:
 			name += " (%s)" % translate_county[ municipality['county'] ]
 
-		filename = "bygninger_%s_%s.geojson" % (municipality['ref'], municipality['name'].replace(" ", "_"))
-		file_path = os.path.expanduser(import_folder + filename)
-
-		file = open(file_path)
-		buildings = json.load(file)
-		file.close()
-
-		count_box = 0
-		count_moved = 0
-		count_polygons = 0
+		data, error = building_queue.get()
+		if error is not None:
+			raise error
 
 		# Create bbox for each building which has polygon (used for filtering later)
 
-		for building in buildings['features']:
-			if building['geometry']['type'] == "Polygon":
-				building['min_bbox'] = (min([ node[0] for node in building['geometry']['coordinates'][0] ]), \
-										min([ node[1] for node in building['geometry']['coordinates'][0] ]))
+		buildings = index_buildings(data['features'])
 
-				building['max_bbox'] = (max([ node[0] for node in building['geometry']['coordinates'][0] ]), \
-										max([ node[1] for node in building['geometry']['coordinates'][0] ]))	
-				count_polygons += 1
-
-		if count_polygons == 0:
+		if not buildings:
 			message ("No building polygons\n")
 			continue
 
-		buildings = [building for building in buildings['features'] if 'min_bbox' in building]
-
-		# Loop each box and identify any building around it
+		# Relocate each box which is inside a building
 
-		for box in post_boxes:
-			if box['municipality'] == name:
-				count_box += 1
+		boxes = [box for box in post_boxes if box['municipality'] == name]
+		results = relocate([box['point'] for box in boxes], buildings, wall_threshold, wall_offset)
 
-				# Check if post box is inside a building
-
-				for building in buildings:
-
-					if building['min_bbox'][0] < box['point'][0] < building['max_bbox'][0] and \
-							building['min_bbox'][1] < box['point'][1] < building['max_bbox'][1] and \
-							inside_polygon(box['point'], building['geometry']['coordinates'][0]):
-
-						point, distance = closest_line(box['point'], building['geometry']['coordinates'])
-						box['distance'] = "%.1f" % distance
-						if distance < wall_threshold:
-
-							# Check if point is inside another building (if so, abort the relocation)
-
-							still_inside = False
-
-							for building2 in buildings:
-								if building2['min_bbox'][0] < point[0] < building2['max_bbox'][0] and \
-										building2['min_bbox'][1] < point[1] < building2['max_bbox'][1] and \
-										inside_polygon(point, building2['geometry']['coordinates'][0]):
-									still_inside = True
-									break
+		count_moved = 0
+		for box, (point, distance, moved) in zip(boxes, results):
+			if distance is not None:
+				box['distance'] = "%.1f" % distance
+			if moved:
+				box['point'] = point
+				count_moved += 1
 
-							if not still_inside:
-								box['point'] = point
-								count_moved += 1
-								total_moved += 1
-								break
+		total_moved += count_moved
 
-		message ("%i of %i post boxes moved\n" % (count_moved, count_box))
+		message ("%i of %i post boxes moved\n" % (count_moved, len(boxes)))
 
 	message ("\tTotal %i of %i post boxes moved\n" % (total_moved, len(post_boxes)))
 
@@ -449,18 +686,11 @@ def save_mailbox():
 	Save mailboxes to OSM file.
 	'''
 
-	global file
+	global tags
 
 	message ("Save mail boxes ...\n")
 
-	# Produce OSM file header
-
-	filename = "postkasser_vegg.osm"
-	file = open(filename, "w")
-
-	file.write ('<?xml version="1.0" encoding="UTF-8"?>\n')
-	file.write ('<osm version="0.6" generator="postbox2osm v%s" upload="false">\n' % version)
-
+	nodes = []
 	node_id = -1000
 
 	# Iterate all mail boxes and produce OSM tags
@@ -472,7 +702,7 @@ def save_mailbox():
 		longitude = round(box['point'][0], 7)
 		latitude = round(box['point'][1], 7)
 
-		file.write ('  <node id="%i" lat="%f" lon="%f">\n' % (node_id, latitude, longitude))
+		tags = []
 
 		if latitude < 57:
 			make_osm_line ("GEOCODE", "yes")
@@ -490,14 +720,30 @@ def save_mailbox():
 		if "distance" in box:
 			make_osm_line ("DISTANCE", box['distance'])
 
-		file.write ('  </node>\n')
+		nodes.append((node_id, "%f" % latitude, "%f" % longitude, tags))
+
+	# Save to one file for each format
+
+	keys = []  # Columns for CSV output
+	for node in nodes:
+		for key, value in node[3]:
+			if key not in keys:
+				keys.append(key)
+
+	filenames = [ osmfile.output_filename("postkasser_vegg", file_format) for file_format in output_formats ]
+	outputs = [ osmfile.open_writer(filename, "postbox2osm v%s" % version, file_format, keys)
+				for filename, file_format in zip(filenames, output_formats) ]
+
+	for node_id, latitude, longitude, tags in nodes:
+		for output in outputs:
+			output.node(node_id, latitude, longitude, tags)
 
 	# Wrap up
 
-	file.write ('</osm>\n')
-	file.close()
+	for output in outputs:
+		output.close()
 
-	message ("\t%i post boxes saved to '%s'\n\n" % (len(post_boxes), filename))
+	message ("\t%i post boxes saved to '%s'\n\n" % (len(post_boxes), "', '".join(filenames)))
 
 
 
@@ -508,12 +754,23 @@ if __name__ == '__main__':
 	municipalities = []
 	post_boxes = []
 
+	replay = "--replay" in sys.argv
+
 	load_municipalities()
 
+	if "--format" in sys.argv and sys.argv.index("--format") + 1 < len(sys.argv):
+		output_formats = list(dict.fromkeys(sys.argv[sys.argv.index("--format") + 1].split(",")))  # Without duplicates
+		for file_format in output_formats:
+			if file_format not in osmfile.file_formats:
+				sys.exit("Unknown format '%s', use one or more of: %s" % (file_format, ",".join(osmfile.file_formats)))
+
 	if "--api" in sys.argv:
 		load_mailbox_api()
 	else:
-		load_mailbox_file()
+		load_mailbox_file(osmfile.output_filename("postkasser", output_formats[0]))
+
+	if "--geocode" in sys.argv:
+		geocode_mailbox()
 
 	check_mailbox()
 	save_mailbox()
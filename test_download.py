@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# test_download
+# Tests download.py against a local fault-injecting stand-in server (connection reset, 503, stall, no Range support and changed document).
+# Usage: python -m unittest test_download
+
+
+import os
+import time
+import socket
+import tempfile
+import threading
+import unittest
+import http.server
+
+import download
+
+
+class FaultHandler(http.server.BaseHTTPRequestHandler):
+	'''
+	Serves the current document of the server. The fault for each request is taken from the server's list of faults.
+	'''
+
+	def log_message(self, *args):
+		pass
+
+
+	def do_GET(self):
+
+		server = self.server
+		server.requests.append(dict(self.headers))
+		fault = server.faults.pop(0) if server.faults else None
+
+		if fault == "503":
+			self.send_response(503)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+
+		body = server.bodies[ min(len(server.requests), len(server.bodies)) - 1 ]
+		etag = '"%i"' % hash(body) if server.etag else None
+
+		# Honour Range only if supported and If-Range (if given) matches current document
+
+		start = 0
+		range_header = self.headers.get("Range")
+		if range_header and server.range and self.headers.get("If-Range", etag) == etag:
+			start = int(range_header[6:].split("-")[0])
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes %i-%i/%i" % (start, len(body) - 1, len(body)))
+		else:
+			self.send_response(200)
+
+		self.send_header("Content-Length", str(len(body) - start))
+		if etag:
+			self.send_header("ETag", etag)
+		self.end_headers()
+
+		data = body[ start : ]
+
+		if fault == "reset":
+			self.wfile.write(data[ : len(data) // 3 ])
+			self.wfile.flush()
+			self.connection.shutdown(socket.SHUT_RDWR)
+		elif fault == "stall":
+			self.wfile.write(data[ : len(data) // 3 ])
+			self.wfile.flush()
+			time.sleep(download.read_timeout * 3)
+		else:
+			self.wfile.write(data)
+
+
+
+class TestDownload(unittest.TestCase):
+
+	def setUp(self):
+
+		self.settings = (download.read_timeout, download.retry_delay, download.max_retries)
+		download.read_timeout = 0.3
+		download.retry_delay = 0.01
+		download.max_retries = 3
+
+		self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FaultHandler)
+		self.server.daemon_threads = True
+		self.server.requests = []
+		self.server.faults = []
+		self.server.bodies = [ b"<data>" + b"0123456789" * 20000 + b"</data>" ]
+		self.server.range = True
+		self.server.etag = True
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+		self.url = "http://127.0.0.1:%i/data" % self.server.server_address[1]
+		self.folder = tempfile.TemporaryDirectory()
+		self.tee_filename = os.path.join(self.folder.name, "tee.xml")
+
+
+	def tearDown(self):
+
+		self.server.shutdown()
+		self.server.server_close()
+		self.folder.cleanup()
+		download.read_timeout, download.retry_delay, download.max_retries = self.settings
+
+
+	def download(self):
+		'''
+		Download all data from server and check that the tee file is the same as the returned data.
+		'''
+
+		with download.open_url(self.url, self.tee_filename) as file:
+			data = file.read()
+
+		with open(self.tee_filename, "rb") as file:
+			self.assertEqual(file.read(), data)
+		self.assertFalse(os.path.exists(self.tee_filename + ".part"))
+
+		return data
+
+
+	def test_reset_resumes_with_range(self):
+
+		self.server.faults = ["reset"]
+		self.assertEqual(self.download(), self.server.bodies[0])
+		self.assertEqual(len(self.server.requests), 2)
+		self.assertIn("Range", self.server.requests[1])
+		self.assertIn("If-Range", self.server.requests[1])
+
+
+	def test_503_is_retried(self):
+
+		self.server.faults = ["503", "503"]
+		self.assertEqual(self.download(), self.server.bodies[0])
+		self.assertEqual(len(self.server.requests), 3)
+
+
+	def test_stall_is_retried(self):
+
+		self.server.faults = ["stall"]
+		self.assertEqual(self.download(), self.server.bodies[0])
+		self.assertEqual(len(self.server.requests), 2)
+
+
+	def test_no_range_skips_delivered_data(self):
+
+		self.server.range = False
+		self.server.faults = ["reset"]
+		self.assertEqual(self.download(), self.server.bodies[0])
+
+
+	def test_changed_document_restarts(self):
+
+		self.server.range = False
+		self.server.etag = False
+		self.server.faults = ["reset"]
+		self.server.bodies.append(b"<data>" + b"abcdefghij" * 25000 + b"</data>")
+		self.assertEqual(self.download(), self.server.bodies[1])
+
+
+	def test_changed_etag_restarts(self):
+
+		self.server.faults = ["reset"]
+		self.server.bodies.append(b"<data>" + b"abcdefghij" * 20000 + b"</data>")
+		self.assertEqual(self.download(), self.server.bodies[1])
+
+
+	def test_changed_document_in_partial_read_fails(self):
+
+		self.server.range = False
+		self.server.etag = False
+		self.server.faults = ["reset"]
+		self.server.bodies.append(b"<data>" + b"abcdefghij" * 25000 + b"</data>")
+
+		with self.assertRaises(download.DocumentChanged):
+			with download.open_url(self.url, self.tee_filename) as file:
+				while file.read(1000):
+					pass
+
+		self.assertFalse(os.path.exists(self.tee_filename))
+		self.assertFalse(os.path.exists(self.tee_filename + ".part"))
+
+
+	def test_too_many_errors_fails(self):
+
+		self.server.faults = ["503"] * 10
+		with self.assertRaises(download.DownloadError):
+			self.download()
+		self.assertFalse(os.path.exists(self.tee_filename + ".part"))
+
+
+	def test_parse_error_completes_tee_file(self):
+
+		with self.assertRaises(ValueError):
+			with download.open_url(self.url, self.tee_filename) as file:
+				file.read(1000)
+				raise ValueError("Parse error")
+
+		with open(self.tee_filename, "rb") as file:
+			self.assertEqual(file.read(), self.server.bodies[0])
+
+
+	def test_interrupt_aborts(self):
+
+		self.server.faults = ["stall"] * 10
+		start = time.time()
+
+		with self.assertRaises(KeyboardInterrupt):
+			with download.open_url(self.url, self.tee_filename) as file:
+				file.read(1000)
+				raise KeyboardInterrupt()
+
+		self.assertLess(time.time() - start, download.read_timeout * 2)
+		self.assertFalse(os.path.exists(self.tee_filename + ".part"))
+
+
+	def test_replay(self):
+
+		data = self.download()
+		with download.open_url(self.url, self.tee_filename, replay=True) as file:
+			self.assertEqual(file.read(), data)
+		self.assertEqual(len(self.server.requests), 1)
+
+
+
+if __name__ == '__main__':
+	unittest.main()